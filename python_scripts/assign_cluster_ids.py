@@ -0,0 +1,49 @@
+# # assign_cluster_ids.py
+
+# ## Usage
+#
+# assign_cluster_ids.py [merged_cne_clusters.csv] [pre_filtering_clusters.csv]
+#
+# ## Goal
+#
+# Same steps as assign_cluster_ids.ipynb, for pipelines (run_pipeline.py, benchmark_pipeline.py):
+# - Assign identifier to clusters (cluster_1, cluster_2, ...)
+# - Discard singletons (clusters whose CNEs all belong to one species)
+#
+# ## Input
+#
+# merged_cne_clusters.csv: one cluster of CNE IDs per line (output of merge_all_links.py)
+#
+# ## Output
+#
+# pre_filtering_clusters.csv: cluster ID followed by its CNE IDs (input of parsimony_analysis_part1_with_blast.py)
+#
+# ***
+
+import csv
+import sys
+from cne_io import open_file
+
+if len(sys.argv) > 3 or (len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help")):
+    sys.exit("Usage: assign_cluster_ids.py [merged_cne_clusters.csv] [pre_filtering_clusters.csv]")
+merged_clusters = sys.argv[1] if len(sys.argv) > 1 else "merged_cne_clusters.csv"
+output_clusters = sys.argv[2] if len(sys.argv) > 2 else "pre_filtering_clusters.csv"
+
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+# Species are parsed from the CNE IDs (species_cne_number): cne_ids.py would import NumPy
+from stage_metrics import startup_check
+startup_check()
+
+number_of_clusters = 0
+number_of_singletons = 0
+with open_file(merged_clusters) as input_file, open_file(output_clusters, 'wt') as output_file:
+    writer = csv.writer(output_file, delimiter=',')
+    for row in csv.reader(input_file, delimiter=','):
+        # Exclude clusters of one species
+        if len({cne.split("_cne_")[0] for cne in row}) > 1:
+            number_of_clusters += 1
+            writer.writerow(['cluster_' + str(number_of_clusters)] + row)
+        else:
+            number_of_singletons += 1
+
+print(number_of_clusters, "clusters written to:", output_clusters, "-", number_of_singletons, "singletons discarded")
@@ -0,0 +1,140 @@
+# # benchmark_imports.py
+
+# ## Usage
+#
+# benchmark_imports.py [--repeat 5] [--budget 100] [--help-budget 100] [--command-budget parsimony=150]
+#                      [--output import_times.json]
+#
+# ## Goal
+#
+# Measure the start-up time of each command of cne.py, to guard against slow imports added to the scripts.
+# Each command is run twice:
+# - with --help: it stops once its arguments are parsed (help time, e.g. usage errors of swarm files)
+# - with minimal arguments and CNE_STARTUP_CHECK=1: it stops once the modules of the stage are imported,
+#   just before its first useful work (start-up time, see stage_metrics.startup_check).
+#   Start-up time includes the import of NumPy, most of the start-up time of the stages that use it.
+#   pandas is not imported at start-up: scripts import it in the functions that read or write tables.
+# Times are the shortest wall time of --repeat runs, minus the start-up time of python itself.
+# Modules imported by each command before its first useful work are timed with python -X importtime.
+#
+# Exits with an error if the start-up time of a command is longer than --budget milliseconds
+# (or its own budget, --command-budget), or its help time longer than --help-budget milliseconds.
+#
+# ## Output
+#
+# Help time, start-up time and slowest imported modules of each command, JSON file if --output is given
+#
+# ***
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from os.path import abspath, dirname, join
+
+script_dir = dirname(abspath(__file__))
+cli = join(script_dir, "cne.py")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--budget", type=float, default=100, help="maximum start-up time of a command (ms)")
+parser.add_argument("--help-budget", type=float, default=100, help="maximum time of a command with --help (ms)")
+parser.add_argument("--command-budget", action="append", default=[], metavar="COMMAND=MS",
+                    help="maximum start-up time of one command (ms), instead of --budget (can be repeated)")
+parser.add_argument("--output", help="JSON file of the results")
+args = parser.parse_args()
+
+command_budgets = {}
+for command_budget in args.command_budget:
+    command, _, budget = command_budget.partition("=")
+    try:
+        command_budgets[command] = float(budget)
+    except ValueError:
+        sys.exit("Invalid --command-budget (COMMAND=MS): " + command_budget)
+
+# Commands that run benchmarks are not measured
+skipped = {'benchmark', 'benchmark-imports'}
+
+# #### Minimal arguments of each command
+# Inputs are not read: commands stop before their first useful work
+command_arguments = {'generate-ids': ["cnefinder/"],
+                     'overlaps': ["aaur_vs_epal.out", "aaur_vs_hsym.out", "overlap_files/"],
+                     'split-overlaps': ["aaur_vs_epal.out", "aaur_vs_hsym.out"],
+                     'merge-overlaps': ["overlap_files/", "aaur_overlap_epal_hsym.overlaps"],
+                     'pairwise-links': ["unique_non_overlap_cnes.cnes", "cnefinder/"],
+                     'threeway-links': ["aaur_overlap_epal_hsym.overlaps", "unique_non_overlap_cnes.cnes"],
+                     'merge-links': [],
+                     'cluster-ids': [],
+                     'original-coordinates': ["coords/", "padded_genomes/", "orig_coords/"],
+                     'parsimony': ["pre_filtering_clusters.csv", "tree.nwk", "blastn/"],
+                     'convert': ["unique_non_overlap_cnes.txt"],
+                     'pipeline': ["cnefinder/", "tree.nwk", "blastn/"],
+                     'synthetic-data': ["synthetic_data"]}
+startup_env = dict(os.environ, CNE_STARTUP_CHECK="1")
+
+
+def startup_time(command, env=None):
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+# #### Function that returns the top-level modules imported by a command and their import time (ms)
+# python -X importtime writes one line per module: import time: self [us] | cumulative | imported package
+# Modules imported by python itself at start-up are given in exclude
+def imports(command, exclude=(), n=5, env=None):
+    stderr = subprocess.run([sys.executable, "-X", "importtime"] + command[1:], stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True, env=env).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Modules imported by other modules are indented
+        if not name[1:].startswith(" ") and name.strip() not in exclude:
+            modules.append((name.strip(), int(cumulative) / 1000))
+    return sorted(modules, key=lambda module: module[1], reverse=True)[:n]
+
+
+# #### Commands listed by cne.py --help
+listing = subprocess.run([sys.executable, cli, "--help"], capture_output=True, text=True).stdout
+commands = [line.split()[0] for line in listing.splitlines() if line.startswith("  ")]
+
+python_time = startup_time([sys.executable, "-c", "pass"])
+python_modules = {name for name, _ in imports([sys.executable, "-c", "pass"], n=None)}
+print("python start-up:", round(python_time), "ms")
+results = {'python': sys.version, 'python_startup_ms': python_time, 'budget_ms': args.budget,
+           'command_budgets_ms': command_budgets, 'help_budget_ms': args.help_budget, 'commands': {}}
+slow_commands = []
+print("command".ljust(22), "help".rjust(5), "   ", "start-up".rjust(8), "   slowest imports (ms)")
+for command in commands:
+    if command in skipped:
+        continue
+    if command not in command_arguments:
+        sys.exit("No minimal arguments for command: " + command)
+    help_time = startup_time([sys.executable, cli, command, "--help"]) - python_time
+    arguments = [sys.executable, cli, command] + command_arguments[command]
+    startup = startup_time(arguments, env=startup_env) - python_time
+    slowest_imports = imports(arguments, exclude=python_modules, env=startup_env)
+    budget = command_budgets.get(command, args.budget)
+    results['commands'][command] = {'help_ms': help_time, 'startup_ms': startup, 'budget_ms': budget,
+                                    'slowest_imports_ms': slowest_imports}
+    print(command.ljust(22), str(round(help_time)).rjust(5), "ms", str(round(startup)).rjust(8), "ms  ",
+          ", ".join(name + " " + str(round(ms)) for name, ms in slowest_imports[:3]))
+    if startup > budget or help_time > args.help_budget:
+        slow_commands.append(command)
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+
+if slow_commands:
+    sys.exit("Start-up above budget or help above " + str(args.help_budget) + " ms: "
+             + ", ".join(command + " (" + str(round(results['commands'][command]['startup_ms'])) + " ms, budget "
+                         + str(results['commands'][command]['budget_ms']) + " ms)" for command in slow_commands))
+print("All commands start in less than", args.budget, "ms (or their own budget), help in less than", args.help_budget, "ms")
@@ -0,0 +1,176 @@
+# # benchmark_pipeline.py
+
+# ## Usage
+#
+# benchmark_pipeline.py [--scales 1000,10000,100000] [--species 4] [--work-dir benchmark]
+#                       [--output benchmark_results.json] [--workers N] [--compress gz|bgz]
+#
+# ## Goal
+#
+# Time each stage of the pipeline on synthetic data (make_synthetic_data.py) at several scales,
+# to compare versions of the scripts and track regressions.
+# Stages: generate_cne_ids, calculate_overlaps_split (all pairs of CNEFinder files with one species in common,
+# one run per pair, then one run with --all-pairs),
+# retrieve_pairwise_links, retrieve_threeway_links (one run per overlap file, then one batch run), merge_all_links,
+# retrieve_original_coordinates, assign_cluster_ids and the pastml table build of parsimony_analysis_part1_with_blast
+# (parsimony_table.py).
+#
+# ## Input
+#
+# --scales: numbers of CNEs per CNEFinder file
+# --species: number of species (one CNEFinder file per pair of species)
+# --compress: compress the synthetic CNEFinder, FASTA and Blastn files (see cne_io.py)
+#
+# ## Output
+#
+# JSON file (--output): run information (date, git commit, python version, number of CPUs) and one result
+# per scale and stage: wall time and CPU time (seconds), number of tasks, size of the inputs (bytes).
+# Synthetic data and outputs of each scale are in work_dir/scale_N
+#
+# ***
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from itertools import combinations
+from os.path import abspath, basename, dirname, getsize, join
+from cf_reader import cf_species
+from cne_io import glob_files
+
+script_dir = dirname(abspath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--scales", default="1000,10000,100000", help="comma-separated numbers of CNEs per CNEFinder file")
+parser.add_argument("--species", type=int, default=4)
+parser.add_argument("--work-dir", default="benchmark")
+parser.add_argument("--output", default="benchmark_results.json")
+parser.add_argument("--compress", choices=["gz", "bgz"], help="compressed synthetic inputs")
+parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes of the pastml table build and of the batch run of retrieve_threeway_links")
+args = parser.parse_args()
+
+scales = [int(scale) for scale in args.scales.split(",")]
+output_file = abspath(args.output)
+work_dir = abspath(args.work_dir)
+
+
+def cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(script, arguments):
+    command = [sys.executable, join(script_dir, script)] + arguments
+    if subprocess.run(command, stdout=subprocess.DEVNULL).returncode != 0:
+        sys.exit("Failed: " + " ".join(command))
+
+
+# #### Function that times all runs of a script (one run per list of arguments)
+def time_stage(stage, script, runs, inputs):
+    print("Running stage:", stage, "(" + str(len(runs)), "tasks)")
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    for arguments in runs:
+        run(script, arguments)
+    wall_time = time.perf_counter() - start
+    return {'stage': stage, 'tasks': len(runs), 'wall_time': wall_time,
+            'cpu_time': cpu_time(resource.getrusage(resource.RUSAGE_CHILDREN)) - cpu_time(usage),
+            'input_bytes': sum(path_size(path) for path in inputs)}
+
+
+def path_size(path):
+    if os.path.isdir(path):
+        return sum(getsize(join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return getsize(path)
+
+
+# #### Function that runs all stages on the synthetic data of one scale
+def benchmark_scale(scale):
+    scale_dir = join(work_dir, "scale_" + str(scale))
+    run("make_synthetic_data.py", [scale_dir, "--species", str(args.species), "--cnes", str(scale),
+                                   "--genome-size", str(max(1000000, scale * 200)), "--blast-hits", str(scale)]
+        + (["--compress", args.compress] if args.compress else []))
+    os.chdir(scale_dir)
+    cf_dir = join(scale_dir, "cnefinder") + "/"
+    cf_files = sorted(glob_files(cf_dir + "*.out"))
+    cf_comps = {cf_file: cf_species(cf_file) for cf_file in cf_files}
+    results = [time_stage("generate_cne_ids", "generate_cne_ids.py", [[cf_dir]], cf_files)]
+
+    os.makedirs("overlap_files", exist_ok=True)
+    pairs = [(file1, file2) for file1, file2 in combinations(cf_files, 2)
+             if len(set(cf_comps[file1]) & set(cf_comps[file2])) == 1]
+    results.append(time_stage("calculate_overlaps_split", "calculate_overlaps_split.py",
+                              [[file1, file2, "overlap_files/"] for file1, file2 in pairs], cf_files))
+    os.makedirs("overlap_files_all_pairs", exist_ok=True)
+    results.append(time_stage("calculate_overlaps_all_pairs", "calculate_overlaps_split.py",
+                              [["--all-pairs", cf_dir, "overlap_files_all_pairs/"]], cf_files))
+
+    cne_dict = "unique_non_overlap_cnes.cnes"
+    results.append(time_stage("retrieve_pairwise_links", "retrieve_pairwise_links.py", [[cne_dict, cf_dir]],
+                              [cne_dict] + cf_files))
+    overlap_files = sorted(glob.glob("overlap_files/*"))
+    results.append(time_stage("retrieve_threeway_links", "retrieve_threeway_links.py",
+                              [[overlap_file, cne_dict] for overlap_file in overlap_files], [cne_dict] + overlap_files))
+    results.append(time_stage("retrieve_threeway_links_batch", "retrieve_threeway_links.py",
+                              [["overlap_files/", cne_dict, "--workers", str(args.workers)]],
+                              [cne_dict] + overlap_files))
+    results.append(time_stage("merge_all_links", "merge_all_links.py", [[]],
+                              ["pairwise_links.links"] + glob.glob("threeway_links/*")))
+
+    os.makedirs("coords", exist_ok=True)
+    os.makedirs("orig_coords", exist_ok=True)
+    for coord_file in glob_files("*_cne_coords.tsv"):
+        os.replace(coord_file, join("coords", basename(coord_file)))
+    results.append(time_stage("retrieve_original_coordinates", "retrieve_original_coordinates.py",
+                              [["coords/", join(scale_dir, "genomes") + "/", "orig_coords/"]],
+                              ["coords", "genomes"]))
+
+    # Cluster IDs, clusters of one species are discarded (input of the pastml table)
+    results.append(time_stage("assign_cluster_ids", "assign_cluster_ids.py",
+                              [["merged_cne_clusters.csv", "pre_filtering_clusters.csv"]], ["merged_cne_clusters.csv"]))
+
+    # pastml table build, in this process
+    from parsimony_table import read_blast_files, presence_absence_matrix
+    print("Running stage: parsimony_table")
+    blastn_files = sorted(glob_files(join(scale_dir, "blastn", "*.blastn")))
+    species_list = sorted({sp for comp in cf_comps.values() for sp in comp})
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    hits = read_blast_files(blastn_files, e_value_threshold=0.01, workers=args.workers)
+    presence_absence_matrix("pre_filtering_clusters.csv", hits, species_list)
+    wall_time = time.perf_counter() - start
+    results.append({'stage': 'parsimony_table', 'tasks': 1, 'wall_time': wall_time,
+                    'cpu_time': cpu_time(resource.getrusage(resource.RUSAGE_SELF)) - cpu_time(usage)
+                    + cpu_time(resource.getrusage(resource.RUSAGE_CHILDREN)) - cpu_time(children_usage),
+                    'input_bytes': sum(path_size(path) for path in blastn_files + ["pre_filtering_clusters.csv"])})
+    for result in results:
+        result.update(scale=scale, species=args.species)
+        print(result['stage'], ":", round(result['wall_time'], 2), "s")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "-C", script_dir, "rev-parse", "HEAD"], capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+benchmark = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'git_commit': git_commit(),
+             'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+             'species': args.species, 'scales': scales, 'results': []}
+for scale in scales:
+    print("Scale:", scale, "CNEs per CNEFinder file")
+    benchmark['results'].extend(benchmark_scale(scale))
+    # Results are written after each scale
+    with open(output_file, 'w') as f:
+        json.dump(benchmark, f, indent=1)
+
+print("Benchmark results written to:", output_file)
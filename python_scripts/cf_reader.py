@@ -0,0 +1,94 @@
+# # cf_reader.py
+
+# ## Goal
+#
+# Read CNEFinder output files in batches of rows with compact column types.
+# Shared by generate_cne_ids.py, calculate_overlaps_split.py and retrieve_pairwise_links.py.
+#
+# Columns are renamed to:
+# ref_chrom, ref_start, ref_end, (ref_strand), query_chrom, query_start, query_end, (query_strand),
+# ref_length, query_length, sim
+# Strand columns are only present in stranded CNEFinder output (11 columns).
+#
+# Types: coordinates and lengths uint32, chromosome and strand categorical, similarity float32.
+# Files can be compressed (.gz, .bgz, see cne_io.py).
+#
+# ## Usage
+#
+# ref_species, query_species = cf_species(cf_file)
+# for cnes in read_cf_batches(cf_file, columns=['ref_start', 'ref_end']):
+#     ...
+#
+# ***
+
+from cne_io import open_file
+
+batch_size = 1000000
+
+column_names = ['ref_chrom', 'ref_start', 'ref_end', 'query_chrom', 'query_start', 'query_end',
+                'ref_length', 'query_length', 'sim']
+stranded_column_names = ['ref_chrom', 'ref_start', 'ref_end', 'ref_strand',
+                         'query_chrom', 'query_start', 'query_end', 'query_strand',
+                         'ref_length', 'query_length', 'sim']
+
+column_types = {'ref_chrom': 'category', 'ref_start': 'uint32', 'ref_end': 'uint32', 'ref_strand': 'category',
+                'query_chrom': 'category', 'query_start': 'uint32', 'query_end': 'uint32',
+                'query_strand': 'category', 'ref_length': 'uint32', 'query_length': 'uint32', 'sim': 'float32'}
+
+
+# #### Function that reads the header line of a CNEFinder file
+def read_header(cf_file):
+    with open_file(cf_file) as cf:
+        return cf.readline().rstrip("\n").split("\t")
+
+
+# #### Function that returns the column names of a CNEFinder file
+def cf_column_names(header):
+    if len(header) == len(stranded_column_names):
+        return stranded_column_names
+    return column_names
+
+
+# #### Function that identifies reference and query species
+# Species are taken from the file name: ref_vs_query.out (or a split file ref_vs_query.out_1),
+# otherwise from the header when columns are named after species (e.g. aaur_chrom)
+def cf_species(cf_file, header=None):
+    file_name = cf_file.split("/")[-1].split(".out")[0]
+    if "_vs_" in file_name:
+        ref_species, query_species = file_name.split("_vs_")
+        return ref_species, query_species
+    if header is None:
+        header = read_header(cf_file)
+    names = cf_column_names(header)
+    return header[0].split("_")[0], header[names.index('query_chrom')].split("_")[0]
+
+
+# #### Function that reads a CNEFinder file in batches
+# Yields DataFrames of at most batch_size rows, with only the requested columns (all columns by default)
+# pandas is imported by the functions that read files: scripts that only need cf_species start faster
+def read_cf_batches(cf_file, columns=None, batch_size=batch_size):
+    import pandas as pd
+    names = cf_column_names(read_header(cf_file))
+    if columns is None:
+        columns = names
+    with open_file(cf_file) as cf:
+        reader = pd.read_csv(cf, sep="\t", names=names, header=0, usecols=columns,
+                             dtype={column: column_types[column] for column in columns}, chunksize=batch_size)
+        with reader:
+            for cnes in reader:
+                yield cnes[columns]
+
+
+# #### Function that reads a whole CNEFinder file (only the requested columns)
+def read_cf_file(cf_file, columns=None):
+    import pandas as pd
+    batches = list(read_cf_batches(cf_file, columns))
+    if not batches:
+        names = cf_column_names(read_header(cf_file)) if columns is None else columns
+        return pd.DataFrame({column: pd.Series(dtype=column_types[column]) for column in names})
+    cnes = pd.concat(batches, ignore_index=True)
+    # Categories can differ between batches
+    for column in cnes.columns:
+        if column_types[column] == 'category':
+            cnes[column] = cnes[column].astype('category')
+    return cnes
@@ -0,0 +1,56 @@
+# # cne.py
+
+# ## Usage
+#
+# cne.py command [arguments]
+# cne.py command --help
+#
+# ## Goal
+#
+# Single entry point for all stages of the pipeline, e.g. in swarm files:
+# python cne.py overlaps aaur_vs_epal.out_1 aaur_vs_hsym.out_2 overlap_files/
+# Each command runs its script with the given arguments, as if the script was run directly.
+# Only the script of the command is loaded: each script imports its own modules, after parsing its arguments.
+# See benchmark_imports.py for the start-up time of each command.
+#
+# ***
+
+import runpy
+import sys
+from os.path import abspath, dirname, join
+
+script_dir = dirname(abspath(__file__))
+
+# #### Commands and their scripts
+commands = {'generate-ids': 'generate_cne_ids.py',
+            'overlaps': 'calculate_overlaps_split.py',
+            'split-overlaps': 'split_overlap_swarm.py',
+            'merge-overlaps': 'merge_overlaps.py',
+            'pairwise-links': 'retrieve_pairwise_links.py',
+            'threeway-links': 'retrieve_threeway_links.py',
+            'merge-links': 'merge_all_links.py',
+            'cluster-ids': 'assign_cluster_ids.py',
+            'original-coordinates': 'retrieve_original_coordinates.py',
+            'parsimony': 'parsimony_analysis_part1_with_blast.py',
+            'convert': 'convert_to_columnar.py',
+            'pipeline': 'run_pipeline.py',
+            'synthetic-data': 'make_synthetic_data.py',
+            'benchmark': 'benchmark_pipeline.py',
+            'benchmark-imports': 'benchmark_imports.py'}
+
+
+def usage():
+    return ("Usage: cne.py command [arguments]\nCommands:\n"
+            + "\n".join("  " + command.ljust(22) + script for command, script in commands.items()))
+
+
+if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+    print(usage())
+    sys.exit()
+if sys.argv[1] not in commands:
+    sys.exit("Unknown command: " + sys.argv[1] + "\n" + usage())
+
+# The script sees its own name and arguments in sys.argv (e.g. for argparse and stage_metrics.py)
+script = join(script_dir, commands[sys.argv[1]])
+sys.argv = [script] + sys.argv[2:]
+runpy.run_path(script, run_name="__main__")
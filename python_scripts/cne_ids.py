@@ -0,0 +1,75 @@
+# # cne_ids.py
+
+# ## Goal
+#
+# Integer encoding of CNE IDs shared by all scripts.
+# A CNE ID such as "spis_cne_123456" is stored as one 64-bit integer:
+# index of the species in the species table (high bits) and CNE number (low 40 bits).
+# The species table is the sorted list of species names of the CNE dictionary.
+# Intermediate files carry integer arrays, string IDs are only created for final outputs.
+#
+# ## Usage
+#
+# species = species_table(all_species_cne_dict)
+# code = cne_id_to_code("spis_cne_123456", species)
+# cne_id = code_to_cne_id(code, species)
+#
+# ***
+
+import numpy as np
+
+NUMBER_BITS = 40
+NUMBER_MASK = (1 << NUMBER_BITS) - 1
+
+
+# #### Function that creates the species table: sorted species names
+def species_table(species_names):
+    return sorted(species_names)
+
+
+# #### Function that splits a CNE ID into species name and CNE number
+def parse_cne_id(cne_id):
+    species, number = cne_id.split("_cne_")
+    return species, int(number)
+
+
+# #### Function that returns the species name of a CNE ID
+def cne_species(cne_id):
+    return cne_id.split("_cne_")[0]
+
+
+# #### Functions that encode and decode species index and CNE number (scalars or NumPy arrays)
+def encode_cne_id(species_idx, number):
+    return (np.asarray(species_idx, dtype=np.int64) << NUMBER_BITS) | np.asarray(number, dtype=np.int64)
+
+
+def decode_cne_id(code):
+    code = np.asarray(code, dtype=np.int64)
+    return code >> NUMBER_BITS, code & NUMBER_MASK
+
+
+# #### Functions that convert between string IDs and integers
+# species_index is a dictionary {species: index in species table}
+def cne_id_to_code(cne_id, species_index):
+    species, number = parse_cne_id(cne_id)
+    return (species_index[species] << NUMBER_BITS) | number
+
+
+def code_to_cne_id(code, species):
+    code = int(code)
+    return species[code >> NUMBER_BITS] + "_cne_" + str(code & NUMBER_MASK)
+
+
+def format_cne_ids(codes, species):
+    species_idx, numbers = decode_cne_id(codes)
+    return [species[sp] + "_cne_" + str(number) for sp, number in zip(species_idx.tolist(), numbers.tolist())]
+
+
+# #### Function that converts codes to a different species table
+def recode_cne_ids(codes, from_species, to_species):
+    to_index = {species: i for i, species in enumerate(to_species)}
+    remap = np.array([to_index[species] for species in from_species], dtype=np.int64)
+    species_idx, numbers = decode_cne_id(codes)
+    if len(remap) == 0:
+        return np.asarray(codes, dtype=np.int64)
+    return encode_cne_id(remap[species_idx], numbers)
@@ -0,0 +1,150 @@
+# # cne_index.py
+
+# ## Goal
+#
+# Interval index of non-overlapping CNEs, used to retrieve CNE IDs from coordinates.
+# Replaces the linear scan of all_species_cne_dict[species] done for every CNE in
+# retrieve_pairwise_links.py and retrieve_threeway_links.py.
+#
+# ## Input
+#
+# Dictionary of CNEs created with generate_cne_ids.py (unique_non_overlap_cnes.txt)
+# or its filtered version (filtered_cne_dict.txt):
+# {"aaur": {"aaur_cne_0": [0, 0], "aaur_cne_1": [47284721, 47284885], etc
+# Coordinates can also be given as [chrom, start, end] when the chromosome is known.
+# The same dictionary in columnar format can be used (see cne_store.py).
+#
+# ## Usage
+#
+# cne_index = build_cne_index(all_species_cne_dict)
+# cne_index = load_cne_index('filtered_cne_dict.cnes')
+# query_idx, cne_ids = find_overlapping_cnes(cne_index, "aaur", starts, ends)
+# query_idx, cne_codes = find_overlapping_cnes(cne_index, "aaur", starts, ends, key='code')
+#
+# ***
+
+import numpy as np
+from cne_ids import format_cne_ids
+from cne_store import cne_table_from_dict, read_cne_table
+from stage_metrics import profiled
+
+
+# #### Function that creates the sorted arrays of one species (and chromosome)
+# CNEs are sorted by start. max_end is the running maximum of the end coordinates,
+# it is non-decreasing and can be searched even if some CNEs are nested.
+# rank is the position of the CNE in the input dictionary, used to return IDs in dictionary order.
+# code is the integer encoding of the CNE ID (see cne_ids.py), string IDs are created from codes when needed.
+def sort_intervals(cne_codes, starts, ends, ranks, species):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    sorted_ends = ends[order]
+    return {'start': starts[order],
+            'end': sorted_ends,
+            'max_end': np.maximum.accumulate(sorted_ends) if len(order) else sorted_ends,
+            'code': np.asarray(cne_codes, dtype=np.int64)[order],
+            'rank': np.asarray(ranks, dtype=np.int64)[order],
+            'species': species}
+
+
+# #### Function that builds the index from a CNE table (see cne_store.py)
+# Returns {species: {chrom: sorted arrays}}, chrom is None when coordinates have no chromosome
+def cne_index_from_table(columns, species):
+    cne_index = {}
+    species_col = np.asarray(columns['species'])
+    # Rows of each species are contiguous and in dictionary order
+    order = np.argsort(species_col, kind='stable')
+    boundaries = np.searchsorted(species_col[order], np.arange(len(species) + 1))
+    for species_idx, sp in enumerate(species):
+        rows = order[boundaries[species_idx]:boundaries[species_idx + 1]]
+        ranks = np.arange(len(rows))
+        if 'chrom' not in columns:
+            cne_index[sp] = {None: sort_intervals(columns['cne'][rows], columns['start'][rows],
+                                                  columns['end'][rows], ranks, species)}
+            continue
+        chroms = np.asarray(columns['chrom'])[rows]
+        cne_index[sp] = {}
+        for chrom in np.unique(chroms).tolist():
+            chrom_rows = chroms == chrom
+            cne_index[sp][chrom] = sort_intervals(columns['cne'][rows][chrom_rows], columns['start'][rows][chrom_rows],
+                                                  columns['end'][rows][chrom_rows], ranks[chrom_rows], species)
+    return cne_index
+
+
+# #### Function that builds the index from a dictionary of CNEs
+def build_cne_index(all_species_cne_dict):
+    return cne_index_from_table(*cne_table_from_dict(all_species_cne_dict))
+
+
+# #### Function that builds the index from a CNE table or a JSON dictionary file
+def load_cne_index(path):
+    return cne_index_from_table(*read_cne_table(path))
+
+
+# #### Function that finds all intervals overlapping each query (binary search)
+# Overlap test is the same as the one used on the CNE dictionary:
+# (cne_start <= end <= cne_end) or (start <= cne_end <= end)
+# Returns two arrays: index of the query and index of the overlapping interval in the sorted arrays
+def overlap_candidates(intervals, starts, ends):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    # Intervals starting after the end of the query can not overlap
+    hi = np.searchsorted(intervals['start'], ends, side='right')
+    # Intervals before the first one that reaches the query start can not overlap
+    lo = np.searchsorted(intervals['max_end'], starts, side='left')
+    counts = np.maximum(hi - lo, 0)
+    query_idx = np.repeat(np.arange(len(starts)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    interval_idx = np.repeat(lo, counts) + (np.arange(counts.sum()) - first)
+    # Remove nested intervals that end before the query start
+    keep = intervals['end'][interval_idx] >= starts[query_idx]
+    return query_idx[keep], interval_idx[keep]
+
+
+# #### Function that retrieves the IDs of all CNEs overlapping each query
+# key='code' returns integer CNE IDs instead of strings
+# Returns query index and CNE ID of every overlap, ordered by query then by position in the CNE dictionary
+# If chroms is given and the index knows chromosomes, only CNEs on the same chromosome are returned
+@profiled
+def find_overlapping_cnes(cne_index, species, starts, ends, chroms=None, key='id'):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    query_idx = []
+    cne_ids = []
+    ranks = []
+    for chrom, intervals in cne_index.get(species, {}).items():
+        if chroms is None or chrom is None:
+            chrom_queries = np.arange(len(starts))
+        else:
+            chrom_queries = np.flatnonzero(np.asarray(chroms) == chrom)
+        found_query, found_interval = overlap_candidates(intervals, starts[chrom_queries], ends[chrom_queries])
+        query_idx.append(chrom_queries[found_query])
+        if key == 'id':
+            cne_ids.append(np.array(format_cne_ids(intervals['code'][found_interval], intervals['species']),
+                                    dtype=object))
+        else:
+            cne_ids.append(intervals[key][found_interval])
+        ranks.append(intervals['rank'][found_interval])
+    if not query_idx:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=object if key == 'id' else np.int64)
+    query_idx = np.concatenate(query_idx)
+    cne_ids = np.concatenate(cne_ids)
+    order = np.lexsort((np.concatenate(ranks), query_idx))
+    return query_idx[order], cne_ids[order]
+
+
+# #### Function that retrieves the first CNE overlapping each query
+# Same result as scanning the CNE dictionary and stopping at the first overlap.
+# Returns an array of CNE IDs, None (-1 for key='code') if no CNE overlaps the query
+@profiled
+def find_first_cne(cne_index, species, starts, ends, chroms=None, key='id'):
+    query_idx, cne_ids = find_overlapping_cnes(cne_index, species, starts, ends, chroms, key)
+    if key == 'id':
+        first_ids = np.full(len(starts), None, dtype=object)
+    else:
+        first_ids = np.full(len(starts), -1, dtype=np.int64)
+    # Matches are ordered by query, keep the first match of each query
+    is_first = np.ones(len(query_idx), dtype=bool)
+    is_first[1:] = query_idx[1:] != query_idx[:-1]
+    first_ids[query_idx[is_first]] = cne_ids[is_first]
+    return first_ids
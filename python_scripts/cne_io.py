@@ -0,0 +1,145 @@
+# # cne_io.py
+
+# ## Goal
+#
+# Transparent compressed input and output for all scripts.
+# Files ending with .gz or .bgz (gzip or BGZF, e.g. from bgzip) are decompressed while they are read,
+# and compressed while they are written: CNEFinder outputs, padded genomes and Blastn tables can stay compressed.
+#
+# Decompression runs in a separate process (pigz, bgzip or gzip, the first one installed), in parallel with the
+# script that parses the data. pigz and bgzip use CNE_IO_THREADS threads (default: number of CPUs), bgzip
+# decompresses BGZF blocks in parallel. Without these tools, the gzip module is used.
+# Compression: pigz (.gz) or bgzip (.bgz) with CNE_IO_THREADS threads, otherwise the gzip module (.gz)
+# or Bio.bgzf (.bgz).
+#
+# Outputs named by the scripts (e.g. species_cne_coords.tsv) are compressed when the environment variable
+# CNE_COMPRESS is set to gz or bgz, see output_name. Columnar tables (cne_store.py) are never compressed.
+#
+# ## Usage
+#
+# with open_file("aaur_vs_epal.out.gz") as cf:
+#     header = cf.readline()
+# cf_files = glob_files(cf_output_dir + "*.out")   # *.out, *.out.gz and *.out.bgz
+# fasta_file = find_file(padded_fasta_dir + "aaur_pad.fa")   # aaur_pad.fa, or aaur_pad.fa.gz if it exists
+# with open_file(output_name("aaur_cne_coords.tsv"), 'wt') as f:
+#
+# ***
+
+import glob
+import gzip
+import io
+import os
+import shutil
+import subprocess
+
+compressed_extensions = ('.gz', '.bgz')
+threads = os.environ.get("CNE_IO_THREADS", str(os.cpu_count() or 1))
+
+
+# #### Functions that identify compressed files from their extension
+def is_compressed(path):
+    return str(path).endswith(compressed_extensions)
+
+
+# aaur_vs_epal.out.gz -> aaur_vs_epal.out
+def strip_compression(path):
+    for extension in compressed_extensions:
+        if str(path).endswith(extension):
+            return str(path)[:-len(extension)]
+    return str(path)
+
+
+# #### Function that lists the files of a glob pattern, compressed or not
+def glob_files(pattern):
+    return glob.glob(pattern) + [path for extension in compressed_extensions for path in glob.glob(pattern + extension)]
+
+
+# #### Function that returns the path of a file, or of its compressed version if only that one exists
+def find_file(path):
+    if not os.path.exists(path):
+        for extension in compressed_extensions:
+            if os.path.exists(path + extension):
+                return path + extension
+    return path
+
+
+# #### Function that returns the name of an output file, with the extension of CNE_COMPRESS (gz or bgz)
+def output_name(path):
+    compression = os.environ.get("CNE_COMPRESS", "")
+    return path + "." + compression if compression in ("gz", "bgz") else path
+
+
+# #### File object of a compression process
+# Data is read from the output of the process, or written to its input.
+# Closing the file waits for the process and raises an error if it failed.
+class PipeFile:
+
+    def __init__(self, command, file, process, writing):
+        self.command = command
+        self.file = file
+        self.process = process
+        self.writing = writing
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.file.closed:
+            return
+        if not self.writing and self.file.read(1):
+            # File was not read until the end (e.g. header line only): stop decompression
+            self.process.kill()
+            self.file.close()
+            self.process.wait()
+            return
+        self.file.close()
+        if self.process.wait() != 0:
+            raise OSError(" ".join(self.command) + " failed with exit code " + str(self.process.returncode))
+
+
+# #### Function that returns the command of the first compression tool installed, None if there is none
+def compression_command(path, writing):
+    if writing:
+        tools = [["bgzip", "-c", "-@", threads]] if path.endswith(".bgz") else [["pigz", "-c", "-p", threads]]
+    else:
+        # bgzip and pigz also read plain gzip files
+        tools = [["bgzip", "-dc", "-@", threads], ["pigz", "-dc", "-p", threads], ["gzip", "-dc"]]
+        if not path.endswith(".bgz"):
+            tools = [tools[1], tools[0], tools[2]]
+    for tool in tools:
+        if shutil.which(tool[0]):
+            return tool
+    return None
+
+
+# #### Function that opens a file for reading or writing ('rt', 'rb', 'wt', 'wb'), compressed or not
+def open_file(path, mode='rt'):
+    path = str(path)
+    if not is_compressed(path):
+        return open(path, mode)
+    writing = mode.startswith('w')
+    command = compression_command(path, writing)
+    if command is None:
+        if writing and path.endswith(".bgz"):
+            from Bio import bgzf
+            return bgzf.open(path, mode)
+        return gzip.open(path, mode if mode[-1] in 'tb' else mode + 't')
+    if writing:
+        with open(path, 'wb') as output_file:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output_file)
+        file = process.stdin
+    else:
+        process = subprocess.Popen(command + [path], stdout=subprocess.PIPE)
+        file = process.stdout
+    if 't' in mode or mode in ('r', 'w'):
+        file = io.TextIOWrapper(file)
+    return PipeFile(command, file, process, writing)
@@ -0,0 +1,284 @@
+# # cne_store.py
+
+# ## Goal
+#
+# Typed columnar files for CNE dictionaries, overlap files and links, shared by all scripts.
+# A table is a directory with one NumPy .npy file per column and a meta.json file.
+# Columns are memory-mapped when read: loading a table does not parse anything.
+#
+# - CNE dictionary (unique_non_overlap_cnes.cnes, filtered_cne_dict.cnes)
+#   columns: species, cne, start, end (and chrom if known), meta: species table
+# - Overlap file (calculate_overlaps_split.py, merge_overlaps.py)
+#   columns: number, species_start, species_end for each of the three species
+#   merge_overlaps.py can also write JSON Lines (.jsonl): one {"spis_cne_1": {...}} record per line
+# - Links (retrieve_pairwise_links.py, retrieve_threeway_links.py)
+#   columns: cne_codes, link_offsets, meta: species table
+#
+# CNE IDs are stored as integers (see cne_ids.py).
+# JSON files can be compressed (.gz, .bgz, see cne_io.py), tables are not.
+# JSON files of the previous versions are still read by all functions, see convert_to_columnar.py
+#
+# ***
+
+import json
+import os
+import shutil
+import numpy as np
+from pathlib import Path
+from os.path import isdir, isfile, join
+from cne_ids import species_table, cne_id_to_code, format_cne_ids, parse_cne_id
+from cne_io import open_file, strip_compression
+
+
+# #### Functions that write and read a table
+def write_table(table_dir, columns, meta):
+    Path(table_dir).mkdir(parents=True, exist_ok=True)
+    for name, values in columns.items():
+        np.save(join(table_dir, name + ".npy"), np.asarray(values))
+    meta = dict(meta, columns=list(columns))
+    with open(join(table_dir, "meta.json"), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+
+def read_table(table_dir, mmap=True):
+    with open(join(table_dir, "meta.json")) as meta_file:
+        meta = json.load(meta_file)
+    columns = {name: np.load(join(table_dir, name + ".npy"), mmap_mode='r' if mmap else None)
+               for name in meta['columns']}
+    return columns, meta
+
+
+# #### Table written in chunks of rows, memory is bounded by the largest chunk
+# Rows of each column are appended to a raw file, the .npy files are created by close()
+class TableWriter:
+
+    def __init__(self, table_dir, meta):
+        Path(table_dir).mkdir(parents=True, exist_ok=True)
+        self.table_dir = table_dir
+        self.meta = meta
+        self.dtypes = {}
+        # Number of rows of each column
+        self.rows = {}
+
+    def append(self, columns):
+        for name, values in columns.items():
+            # Raw files left by an interrupted run are overwritten
+            mode = 'ab' if name in self.dtypes else 'wb'
+            values = np.ascontiguousarray(values, dtype=self.dtypes.setdefault(name, np.asarray(values).dtype))
+            with open(join(self.table_dir, name + ".raw"), mode) as raw_file:
+                raw_file.write(values.tobytes())
+            self.rows[name] = self.rows.get(name, 0) + len(values)
+
+    def close(self):
+        for name, dtype in self.dtypes.items():
+            raw_path = join(self.table_dir, name + ".raw")
+            with open(join(self.table_dir, name + ".npy"), 'wb') as npy_file, open(raw_path, 'rb') as raw_file:
+                np.lib.format.write_array_header_1_0(npy_file, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                                'fortran_order': False, 'shape': (self.rows[name],)})
+                shutil.copyfileobj(raw_file, npy_file, 1 << 24)
+            os.remove(raw_path)
+        with open(join(self.table_dir, "meta.json"), 'w') as meta_file:
+            json.dump(dict(self.meta, columns=list(self.dtypes)), meta_file)
+
+
+def is_table(path):
+    return isdir(path) and isfile(join(path, "meta.json"))
+
+
+# #### CNE dictionary
+# {"aaur": {"aaur_cne_0": [0, 0], "aaur_cne_1": [47284721, 47284885], etc
+# Rows are in dictionary order
+def cne_table_from_dict(all_species_cne_dict):
+    species = species_table(all_species_cne_dict)
+    species_index = {sp: i for i, sp in enumerate(species)}
+    species_col, codes, starts, ends, chroms = [], [], [], [], []
+    for sp, species_dict in all_species_cne_dict.items():
+        for cne_id, cne_coords in species_dict.items():
+            species_col.append(species_index[sp])
+            codes.append(cne_id_to_code(cne_id, species_index))
+            starts.append(cne_coords[-2])
+            ends.append(cne_coords[-1])
+            if len(cne_coords) == 3:
+                chroms.append(cne_coords[0])
+    columns = {'species': np.array(species_col, dtype=np.int32),
+               'cne': np.array(codes, dtype=np.int64),
+               'start': np.array(starts, dtype=np.int64),
+               'end': np.array(ends, dtype=np.int64)}
+    if chroms:
+        columns['chrom'] = np.array(chroms, dtype=str)
+    return columns, species
+
+
+# meta: additional information, e.g. CNEFinder files of generate_cne_ids.py
+def write_cne_table(table_dir, all_species_cne_dict, meta=None):
+    columns, species = cne_table_from_dict(all_species_cne_dict)
+    write_table(table_dir, columns, dict(meta or {}, kind='cne_dict', species=species))
+
+
+# Returns columns and species table, from a table or a JSON dictionary
+def read_cne_table(path):
+    if is_table(path):
+        columns, meta = read_table(path)
+        return columns, meta['species']
+    with open_file(path) as json_file:
+        return cne_table_from_dict(json.load(json_file))
+
+
+def cne_dict_from_table(columns, species):
+    all_species_cne_dict = {sp: {} for sp in species}
+    cne_ids = format_cne_ids(columns['cne'], species)
+    coords = zip(columns['start'].tolist(), columns['end'].tolist())
+    if 'chrom' in columns:
+        coords = zip(columns['chrom'].tolist(), columns['start'].tolist(), columns['end'].tolist())
+    for sp, cne_id, cne_coords in zip(columns['species'].tolist(), cne_ids, coords):
+        all_species_cne_dict[species[sp]][cne_id] = list(cne_coords)
+    return all_species_cne_dict
+
+
+# #### Overlap files
+# {"spis_cne_1": {"spis": "start:end", "pdam": "start:end", "adig": "start:end"}, ...}
+# species: list of species names, in the order of the dictionary (common species first)
+# numbers: CNE number of each overlap (spis_cne_1 -> 1)
+# starts, ends: arrays of shape (number of overlaps, number of species)
+def write_overlap_table(table_dir, species, numbers, starts, ends):
+    columns = {'number': np.asarray(numbers, dtype=np.int64)}
+    for i, sp in enumerate(species):
+        columns[sp + '_start'] = np.asarray(starts, dtype=np.int64).reshape(-1, len(species))[:, i]
+        columns[sp + '_end'] = np.asarray(ends, dtype=np.int64).reshape(-1, len(species))[:, i]
+    write_table(table_dir, columns, {'kind': 'overlaps', 'species': list(species)})
+
+
+def read_overlap_table(path):
+    if is_table(path):
+        columns, meta = read_table(path)
+        species = meta['species']
+        starts = np.column_stack([columns[sp + '_start'] for sp in species])
+        ends = np.column_stack([columns[sp + '_end'] for sp in species])
+        return species, columns['number'], starts, ends
+    overlaps = {}
+    with open_file(path) as json_file:
+        if strip_compression(path).endswith(".jsonl"):
+            for line in json_file:
+                overlaps.update(json.loads(line))
+        else:
+            overlaps = json.load(json_file)
+    return overlaps_from_dict(overlaps)
+
+
+# #### Function that returns the species of an overlap file without reading its overlaps
+# Json dictionaries are read up to the end of their first overlap. Files without overlaps can have no species
+def read_overlap_species(path, chunk_size=1 << 16):
+    if is_table(path):
+        return read_table(path)[1]['species']
+    with open_file(path) as json_file:
+        if strip_compression(path).endswith(".jsonl"):
+            for line in json_file:
+                if line.strip():
+                    return list(next(iter(json.loads(line).values())))
+            return []
+        text = ""
+        while True:
+            chunk = json_file.read(chunk_size)
+            text += chunk
+            if text.lstrip().startswith("{}"):
+                return []
+            # Coordinates of an overlap are a flat dictionary: its first "}" ends the first overlap
+            if "}" in text:
+                first_overlap = json.loads(text[:text.index("}") + 1] + "}")
+                return list(next(iter(first_overlap.values())))
+            if not chunk:
+                raise ValueError("Incomplete overlap file: " + path)
+
+
+def overlaps_from_dict(overlaps):
+    if not overlaps:
+        return [], np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.int64), np.empty((0, 0), dtype=np.int64)
+    species = list(next(iter(overlaps.values())))
+    numbers = np.array([parse_cne_id(cne_id)[1] for cne_id in overlaps], dtype=np.int64)
+    coords = np.array([[int(value) for sp in species for value in multi_species_coords[sp].split(":")]
+                       for multi_species_coords in overlaps.values()], dtype=np.int64)
+    return species, numbers, coords[:, 0::2], coords[:, 1::2]
+
+
+# #### Function that writes overlap files in chunks (e.g. merge_overlaps.py)
+# chunks: iterator of (species, numbers, starts, ends), with the same species order in all chunks
+# Output is a json dictionary if the file name ends with .txt or .json, JSON Lines if it ends with .jsonl
+# (followed by .gz or .bgz for compressed output), a columnar table otherwise. Returns the number of overlaps written
+def write_overlap_chunks(path, chunks):
+    if strip_compression(path).endswith((".txt", ".json", ".jsonl")):
+        lines = strip_compression(path).endswith(".jsonl")
+        rows = 0
+        with open_file(path, 'wt') as outfile:
+            # Same text as json.dump of the whole dictionary
+            outfile.write("" if lines else "{")
+            for species, numbers, starts, ends in chunks:
+                for cne_id, multi_species_coords in overlaps_to_dict(species, numbers, starts, ends).items():
+                    if lines:
+                        outfile.write(json.dumps({cne_id: multi_species_coords}) + "\n")
+                    else:
+                        outfile.write((", " if rows else "") + json.dumps(cne_id) + ": " + json.dumps(multi_species_coords))
+                    rows += 1
+            outfile.write("" if lines else "}")
+        return rows
+    writer = None
+    for species, numbers, starts, ends in chunks:
+        if writer is None:
+            writer = TableWriter(path, {'kind': 'overlaps', 'species': list(species)})
+        columns = {'number': np.asarray(numbers, dtype=np.int64)}
+        for i, sp in enumerate(species):
+            columns[sp + '_start'] = np.asarray(starts, dtype=np.int64).reshape(-1, len(species))[:, i]
+            columns[sp + '_end'] = np.asarray(ends, dtype=np.int64).reshape(-1, len(species))[:, i]
+        writer.append(columns)
+    if writer is None:
+        write_overlap_table(path, [], np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.int64),
+                            np.empty((0, 0), dtype=np.int64))
+        return 0
+    writer.close()
+    return writer.rows['number']
+
+
+def overlaps_to_dict(species, numbers, starts, ends):
+    overlaps = {}
+    starts = np.asarray(starts).tolist()
+    ends = np.asarray(ends).tolist()
+    for number, cne_starts, cne_ends in zip(np.asarray(numbers).tolist(), starts, ends):
+        overlaps[species[0] + "_cne_" + str(number)] = {sp: str(start) + ":" + str(end) for sp, start, end
+                                                        in zip(species, cne_starts, cne_ends)}
+    return overlaps
+
+
+# #### Links
+# Links of any length are stored flat: CNE codes of link i are cne_codes[link_offsets[i]:link_offsets[i + 1]]
+def links_to_arrays(links):
+    cne_codes = np.fromiter((code for link in links for code in link), dtype=np.int64)
+    link_offsets = np.zeros(len(links) + 1, dtype=np.int64)
+    link_offsets[1:] = np.cumsum([len(link) for link in links])
+    return cne_codes, link_offsets
+
+
+def write_links(table_dir, links, species):
+    cne_codes, link_offsets = links_to_arrays(links)
+    write_table(table_dir, {'cne_codes': cne_codes, 'link_offsets': link_offsets},
+                {'kind': 'links', 'species': list(species)})
+
+
+# #### Links of several files written to one table, one file at a time (see TableWriter)
+class LinksWriter:
+
+    def __init__(self, table_dir, species):
+        self.writer = TableWriter(table_dir, {'kind': 'links', 'species': list(species)})
+        self.writer.append({'cne_codes': np.empty(0, dtype=np.int64), 'link_offsets': np.zeros(1, dtype=np.int64)})
+        self.links = 0
+
+    def append(self, cne_codes, link_offsets):
+        self.writer.append({'cne_codes': cne_codes,
+                            'link_offsets': link_offsets[1:] + self.writer.rows['cne_codes']})
+        self.links += len(link_offsets) - 1
+
+    def close(self):
+        self.writer.close()
+
+
+def read_links(table_dir):
+    columns, meta = read_table(table_dir)
+    return columns['cne_codes'], columns['link_offsets'], meta['species']
@@ -0,0 +1,69 @@
+# # convert_to_columnar.py
+
+# ## Usage
+#
+# convert_to_columnar.py json_file [output]
+#
+# ## Goal
+#
+# Convert json files of the pipeline to columnar tables (see cne_store.py)
+#
+# ## Input
+#
+# One of:
+# - dictionary of CNEs (unique_non_overlap_cnes.txt, filtered_cne_dict.txt)
+# - overlap file (calculate_overlaps_split.py, merge_overlaps.py)
+# - list of links (pairwise_links.json, threeway_links/*.json)
+#
+# ## Output
+#
+# Columnar table named after the input file, unless output is given:
+# filtered_cne_dict.txt -> filtered_cne_dict.cnes
+# spis_overlap_adig_pdam.txt -> spis_overlap_adig_pdam.overlaps
+# pairwise_links.json -> pairwise_links.links
+# Json files can be compressed (see cne_io.py): filtered_cne_dict.txt.gz -> filtered_cne_dict.cnes
+#
+# ***
+
+import json
+import sys
+from os.path import splitext
+from cne_io import open_file, strip_compression
+
+if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+    sys.exit("Usage: convert_to_columnar.py json_file [output]")
+json_file_name = sys.argv[1]
+output = sys.argv[2] if len(sys.argv) > 2 else None
+
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+from cne_ids import species_table, cne_species, cne_id_to_code
+from cne_store import write_cne_table, write_overlap_table, overlaps_from_dict, write_links
+from stage_metrics import startup_check
+startup_check()
+
+print("reading json file:", json_file_name)
+with open_file(json_file_name) as json_file:
+    json_data = json.load(json_file)
+
+# #### Identify type of json file
+if isinstance(json_data, list):
+    kind = "links"
+elif json_data and isinstance(next(iter(json_data.values())), dict) \
+        and isinstance(next(iter(next(iter(json_data.values())).values()), None), list):
+    kind = "cnes"
+else:
+    kind = "overlaps"
+
+if output is None:
+    output = splitext(strip_compression(json_file_name))[0] + "." + kind
+
+print("writing", kind, "table:", output)
+if kind == "cnes":
+    write_cne_table(output, json_data)
+elif kind == "overlaps":
+    write_overlap_table(output, *overlaps_from_dict(json_data))
+else:
+    species = species_table({cne_species(cne_id) for link in json_data for cne_id in link})
+    species_index = {sp: i for i, sp in enumerate(species)}
+    write_links(output, [[cne_id_to_code(cne_id, species_index) for cne_id in link] for link in json_data], species)
+print("Done")
@@ -0,0 +1,155 @@
+# # disjoint_set.py
+
+# ## Goal
+#
+# Cluster CNEs linked by pairwise and threeway links (union-find).
+# CNEs (string or integer IDs, see cne_ids.py) are numbered in order of first appearance,
+# parents and ranks are stored in NumPy arrays.
+# Memory is proportional to the number of distinct CNEs: links are added one at a time and are not stored.
+#
+# ## Usage
+#
+# cne_clusters = DisjointSet()
+# for link in read_links('pairwise_links.json'):
+#     cne_clusters.add_link(link)
+# merged_list = list(cne_clusters.clusters())
+# cne_clusters.save('cne_clusters.state', {'species': species})
+# cne_clusters = DisjointSet.load('cne_clusters.state')
+#
+# ***
+
+import json
+import re
+import numpy as np
+from cne_io import open_file
+from cne_store import read_table, write_table
+from stage_metrics import profiled
+
+separators = re.compile(r"[ \t\r\n,]*")
+
+
+# #### Function that reads a json list of links one link at a time
+# [[sp1_cne_X, sp2_cne_X], [sp1_cne_X, sp2_cne_X, sp3_cne_X] ... ]
+# Links are decoded from a position in the buffer, which is only trimmed when the next chunk is read
+def read_links(links_file, chunk_size=1 << 20):
+    decoder = json.JSONDecoder()
+    with open_file(links_file) as json_file:
+        buffer = ""
+        position = 0
+        opened = False
+        while True:
+            position = separators.match(buffer, position).end()
+            if opened and buffer.startswith("]", position):
+                return
+            if not opened and buffer.startswith("[", position):
+                position += 1
+                opened = True
+                continue
+            try:
+                link, position_end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Link is incomplete (or buffer is empty), read next chunk of the file
+                next_chunk = json_file.read(chunk_size)
+                if not next_chunk:
+                    raise ValueError("Incomplete list of links in " + links_file)
+                buffer = buffer[position:] + next_chunk
+                position = 0
+                continue
+            if not opened:
+                raise ValueError("Expected a list of links in " + links_file)
+            yield link
+            position = position_end
+
+
+class DisjointSet:
+
+    def __init__(self, size=1024):
+        self.parent = np.arange(size, dtype=np.int64)
+        self.rank = np.zeros(size, dtype=np.int8)
+        self.cne_ids = {}
+        self.names = []
+
+    # #### Function that returns the integer of a CNE ID, new CNEs are added as their own cluster
+    def encode(self, cne_id):
+        code = self.cne_ids.get(cne_id)
+        if code is None:
+            code = len(self.names)
+            if code == len(self.parent):
+                # Double the size of the arrays
+                self.parent = np.concatenate((self.parent, np.arange(code, 2 * code, dtype=np.int64)))
+                self.rank = np.concatenate((self.rank, np.zeros(code, dtype=np.int8)))
+            self.cne_ids[cne_id] = code
+            self.names.append(cne_id)
+        return code
+
+    # #### Function that finds the root of a CNE, with path compression
+    def find(self, code):
+        parent = self.parent
+        root = code
+        while parent[root] != root:
+            root = parent[root]
+        while parent[code] != root:
+            parent[code], code = root, parent[code]
+        return root
+
+    # #### Function that merges the clusters of two CNEs, union by rank
+    def union(self, code1, code2):
+        root1 = self.find(code1)
+        root2 = self.find(code2)
+        if root1 == root2:
+            return
+        if self.rank[root1] < self.rank[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        if self.rank[root1] == self.rank[root2]:
+            self.rank[root1] += 1
+
+    # #### Function that adds a link (list of homologous CNEs)
+    @profiled
+    def add_link(self, link):
+        codes = [self.encode(cne_id) for cne_id in link]
+        for code in codes[1:]:
+            self.union(codes[0], code)
+
+    # #### Function that returns the root of every CNE
+    def roots(self):
+        roots = self.parent[:len(self.names)].copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
+
+    # #### Function that yields all clusters
+    # Clusters are ordered by first appearance of their CNEs in the links, CNE IDs are sorted within each cluster
+    # format_id converts each CNE before sorting, e.g. integer IDs to strings
+    def clusters(self, format_id=None):
+        roots = self.roots()
+        order = np.argsort(roots, kind='stable')
+        sorted_roots = roots[order]
+        boundaries = np.flatnonzero(sorted_roots[1:] != sorted_roots[:-1]) + 1
+        groups = np.split(order, boundaries) if len(order) else []
+        # First CNE of each group is the first to appear in the links
+        for group in sorted(groups, key=lambda group: group[0]):
+            if format_id is None:
+                yield sorted(self.names[code] for code in group.tolist())
+            else:
+                yield sorted(format_id(self.names[code]) for code in group.tolist())
+
+    # #### Functions that save and load the clusters (columnar table, see cne_store.py)
+    # CNE IDs must be integers. meta: additional information, e.g. species table of the CNE IDs
+    def save(self, table_dir, meta):
+        size = len(self.names)
+        write_table(table_dir, {'names': np.array(self.names, dtype=np.int64), 'parent': self.parent[:size],
+                                'rank': self.rank[:size]}, dict(meta, kind='clusters'))
+
+    @classmethod
+    def load(cls, table_dir):
+        columns, meta = read_table(table_dir, mmap=False)
+        size = len(columns['names'])
+        cne_clusters = cls(max(2 * size, 1024))
+        cne_clusters.parent[:size] = columns['parent']
+        cne_clusters.rank[:size] = columns['rank']
+        cne_clusters.names = columns['names'].tolist()
+        cne_clusters.cne_ids = {cne_id: code for code, cne_id in enumerate(cne_clusters.names)}
+        return cne_clusters, meta
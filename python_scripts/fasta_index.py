@@ -0,0 +1,74 @@
+# # fasta_index.py
+
+# ## Goal
+#
+# Scaffold lengths of a FASTA file without parsing sequences.
+# If a samtools index (fasta_file.fai) exists and is newer than the FASTA file, lengths are read from it.
+# Otherwise the FASTA file is read once, residues are counted line by line and a .fai file is written
+# next to it (same format as samtools faidx), so later runs start instantly.
+# Compressed FASTA files (.gz, .bgz, see cne_io.py) are read while they are decompressed,
+# offsets of the .fai file are then offsets in the decompressed file (as samtools faidx does for BGZF files).
+#
+# .fai columns: scaffold name, length, offset of first residue, residues per line, bytes per line
+#
+# ## Usage
+#
+# scaffold_lengths = read_scaffold_lengths("adig_pad.fa")
+#
+# ***
+
+import os
+from collections import OrderedDict
+from cne_io import open_file
+
+
+# #### Function that reads scaffold lengths from a .fai file
+def read_fai(fai_file):
+    scaffold_lengths = OrderedDict([])
+    with open(fai_file) as fai:
+        for line in fai:
+            fields = line.rstrip("\n").split("\t")
+            scaffold_lengths[fields[0]] = int(fields[1])
+    return scaffold_lengths
+
+
+# #### Function that creates the .fai entries of a FASTA file
+# Scaffold name is the first word of the header line, as in SeqIO
+# Returns list of [name, length, offset, line_bases, line_width]
+def index_fasta(fasta_file):
+    entries = []
+    entry = None
+    offset = 0
+    with open_file(fasta_file, 'rb') as fasta:
+        for line in fasta:
+            if line.startswith(b">"):
+                name = line[1:].split(None, 1)
+                entry = [name[0].decode() if name else "", 0, offset + len(line), 0, 0]
+                entries.append(entry)
+            elif entry is not None:
+                residues = len(line.rstrip(b"\r\n")) - line.count(b" ")
+                if entry[3] == 0:
+                    entry[3] = residues
+                    entry[4] = len(line)
+                entry[1] += residues
+            offset += len(line)
+    return entries
+
+
+def write_fai(fai_file, entries):
+    with open(fai_file, 'w') as fai:
+        for entry in entries:
+            fai.write("\t".join(str(value) for value in entry) + "\n")
+
+
+# #### Function that returns scaffold lengths in FASTA order
+def read_scaffold_lengths(fasta_file):
+    fai_file = fasta_file + ".fai"
+    if os.path.isfile(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(fasta_file):
+        return read_fai(fai_file)
+    entries = index_fasta(fasta_file)
+    try:
+        write_fai(fai_file, entries)
+    except OSError:
+        print("Could not write index file: ", fai_file)
+    return OrderedDict((entry[0], entry[1]) for entry in entries)
@@ -5,22 +5,42 @@
 
 # ## Usage
 # 
-# generate_cne_ids.py cnefinder_out_dir
+# generate_cne_ids.py cnefinder_out_dir [--incremental] [--cne-dict unique_non_overlap_cnes.cnes]
 # 
 # ## Goal
 # 
 # Cluster overlapping CNEs from one species across multiple CNEFinder runs (pairwise comparisons)
 # 
+# With --incremental, only the CNEFinder files that are not in the existing dictionary of CNEs (--cne-dict,
+# written by a previous run) are read, e.g. the comparisons of a new species. Their CNEs are merged with the
+# existing CNEs of each species, CNE IDs that did not change are kept:
+# - CNEs that overlap no existing CNE are new CNEs, numbered after the last CNE of the species
+# - an existing CNE that overlaps new CNEs keeps its ID, its coordinates are extended
+# - existing CNEs joined by a new CNE are merged into the one with the smallest number, the others are retired
+# CNEs are never split: coordinates are only added. Species of the new files only are processed.
+# 
 # ## Input
 # 
-# directory containing all CNEfinder output files. 
+# directory containing all CNEfinder output files (can be compressed: .gz, .bgz, see cne_io.py). 
 # 
 # ## Output
 # 
 # 1. Dictionary of CNEs and their coordinates for each species, named 'unique_non_overlap_cnes.txt'  
 # {"aaur": {"aaur_cne_0": [0, 0], "aaur_cne_1": [47284721, 47284885], "aaur_cne_2": [216228632, 216228834], etc  
+# Same dictionary in columnar format (see cne_store.py), named 'unique_non_overlap_cnes.cnes' (or --cne-dict,
+# which --incremental reads and updates in place)  
 #   
 # 2. Coordinates of each non-redundant CNE. One file oper species, names 'species_cne_coords.tsv'. 
+# Compressed with CNE_COMPRESS=gz or bgz (species_cne_coords.tsv.gz). 
+# With --incremental, only for the species of the new files.
+# 
+# 3. With --incremental, changes of the CNE IDs, appended to 'cne_id_changes.tsv' (read by merge_all_links.py)  
+# run, cne_id, change (new, extended or merged), merged_into, old_start, old_end, start, end  
+# run: number of the --incremental run since the last full run, which removes the file.
+# 
+# The table records the numbering of its CNE IDs: a new numbering ID for each full run, kept by --incremental runs
+# (merge_all_links.py --incremental refuses clusters of another numbering), and the last number of each species
+# (numbers of merged CNEs are not used again).
 # 
 # 
 # ***
@@ -28,148 +48,282 @@
 # In[1]:
 
 
-import pandas as pd
-from Bio import SeqIO
 import sys
 import json
-from collections import Counter
-from os import listdir
-from os.path import isfile, join
-import itertools
-
-
-# #### Increase recursion limit
-# For very large numbers of CNEs, increase value if run fails
-sys.setrecursionlimit(15000)
+import uuid
+import argparse
+from os import listdir, remove
+from os.path import exists, isfile, join, getsize
+from cne_io import open_file, output_name
 
 
 # #### User input
-working_dir = sys.argv[1]
+parser = argparse.ArgumentParser()
+parser.add_argument("working_dir")
+parser.add_argument("--incremental", action="store_true",
+                    help="only read CNEFinder files that are not in the dictionary of CNEs (--cne-dict)")
+parser.add_argument("--cne-dict", default="unique_non_overlap_cnes.cnes",
+                    help="dictionary of CNEs in columnar format, written by this run (and read with --incremental)")
+args = parser.parse_args()
+working_dir = args.working_dir
+
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+# pandas is imported by the functions that write tables (see write_cne_coords)
+import numpy as np
+from cne_ids import decode_cne_id, encode_cne_id, species_table
+from cne_store import write_cne_table, read_table, write_table, is_table, cne_dict_from_table
+from cf_reader import cf_species, read_cf_batches
+from stage_metrics import stage_metrics, profiled, startup_check
+startup_check()
 
 
 # #### List CNEFinder output files
 
 cne_files = [f for f in listdir(working_dir) if isfile(join(working_dir, f))]
+all_cne_files = sorted(cne_files)
+
+# #### Existing dictionary of CNEs (--incremental)
+# The table lists the CNEFinder files it was created from. It is read in memory: it is written again at the end
+cne_table = args.cne_dict
+if args.incremental:
+    if not is_table(cne_table):
+        sys.exit("No dictionary of CNEs to update: " + cne_table)
+    existing_cnes, existing_meta = read_table(cne_table, mmap=False)
+    if 'cf_files' not in existing_meta:
+        sys.exit(cne_table + " does not list its CNEFinder files, run generate_cne_ids.py without --incremental once")
+    all_cne_files = sorted(set(existing_meta['cf_files']) | set(cne_files))
+    cne_files = [f for f in cne_files if f not in existing_meta['cf_files']]
+    if not cne_files:
+        sys.exit("No new CNEFinder files in " + working_dir)
 print("cne_files:", cne_files)
 
 
-# #### Create empty dictionary of cnes for each species
+# #### Create empty lists of cne coordinates for each species
 # 
-# This will be populated by calling parse_pairwise_comps
+# This will be populated with the coordinates of every cnefinder output file
 
-all_species_cne_dict= {}
+all_species_coords = {}
 for file in cne_files:
-    species = file.split(".out")[0].split("_vs_")
+    species = cf_species(working_dir + file)
     for species_name in species:
-        if species_name not in all_species_cne_dict:
-            first_cne_id = species_name + "_cne_0"
-            all_species_cne_dict[species_name] = {first_cne_id: [[0,0]]}
+        if species_name not in all_species_coords:
+            all_species_coords[species_name] = []
 
 
-# #### Column names for reading CNEFinder output files
-#column_names = ['ref_chrom', 'ref_start', 'ref_end', 'ref_strand', 'query_chrom', 'query_start', 'query_end', 'query_strand',
- #                     'ref_length', 'query_length', 'sim']
+# #### Columns read from CNEFinder output files (see cf_reader.py)
+coord_columns = ['ref_start', 'ref_end', 'query_start', 'query_end']
 
 
-# #### Function that parses cnefinder output
+# #### Function that collects cne coordinates from cnefinder output
 # 
-# Identify cnes with overlapping coordinates from different cnefinder runs
+# First species of the file name is the reference, second species is the query
+@profiled
 def parse_pairwise_comps(species, comp):
-    for index, row in comp.iterrows():
-        ref_query = "ref"
-        for species_name in species:
-            i = 0
-            # Create a dictionary for this species
-            species_dict = all_species_cne_dict[species_name]
-            # Determine if species was query or reference in cnefinder run
-            # Retrieve coordinates of cne for each species in pair
-            if ref_query == "ref":
-                start = row['ref_start']
-                end = row['ref_end']
-            elif ref_query == "query":
-                start = row['query_start']
-                end = row['query_end']
-            # Loop through existing cnes for this species
-            for cne_id, cne_coord in all_species_cne_dict[species_name].copy().items():
-                for coord_set in cne_coord:
-                    cne_start = coord_set[0]
-                    cne_end = coord_set[1]
-                    # Search for overlaps between current cne and existing cnes
-                    # if overlap, append coordinates to cne
-                    if (cne_start <= end <= cne_end) or (start <= cne_end <= end) :
-                        all_species_cne_dict[species_name][cne_id].append([start, end])
-                        i = 1
-                        break
-            # If no overlap was found, create new_cne
-            if i == 0:
-                new_cne_id = species_name + "_cne_" + str(len(all_species_cne_dict[species_name]))
-                all_species_cne_dict[species_name][new_cne_id] = []
-                all_species_cne_dict[species_name][new_cne_id].append([start, end])
-            ref_query = "query"
-
-
-# #### Function that extends CNE coordinates
-# For each cne with set of overlapping coordinates, create the largest range that includes all coordinates
-def extend_cne_coords(species_dict):
-    new_dict = {}
-    for cne_id, cne_coords in species_dict.items():
-        new_start = (min([j for i in cne_coords for j in i]))
-        new_end = (max([j for i in cne_coords for j in i]))
-        new_dict[cne_id] = [new_start, new_end]
-    return(new_dict)
-
-
-# #### Function that recursively merge overlapping coordinates
-def recursive_merge(inter, start_index = 0):
-    for i in range(start_index, len(inter) - 1):
-        if inter[i][1] > inter[i+1][0]:
-            new_start = inter[i][0]
-            new_end = inter[i+1][1]
-            inter[i] = [new_start, new_end]
-            del inter[i+1]
-            return recursive_merge(inter.copy(), start_index=i)
-    return inter
+    ref_query = "ref"
+    for species_name in species:
+        coords = comp[[ref_query + '_start', ref_query + '_end']].to_numpy(dtype='uint32')
+        all_species_coords[species_name].append(coords)
+        ref_query = "query"
+
+
+# #### Function that groups overlapping coordinates
+# Coordinates are sorted by start, then grouped with a single sweep:
+# a new cne starts when its start is after the end of all previous coordinates.
+# Overlap test is the same as for cne IDs: coordinates sharing at least one position are merged.
+# Returns sort order of the coordinates, group of each sorted coordinate, start and end of each group
+def sweep_groups(coords):
+    order = np.lexsort((coords[:, 1], coords[:, 0]))
+    coords = coords.astype(np.int64)[order]
+    starts = coords[:, 0]
+    max_ends = np.maximum.accumulate(coords[:, 1])
+    new_cne = np.ones(len(coords), dtype=bool)
+    new_cne[1:] = starts[1:] > max_ends[:-1]
+    cne_starts = np.flatnonzero(new_cne)
+    cne_ends = np.append(cne_starts[1:], len(coords)) - 1
+    return order, np.cumsum(new_cne) - 1, starts[cne_starts], max_ends[cne_ends]
+
+
+# #### Function that merges overlapping coordinates
+@profiled
+def sweep_merge(coords):
+    if len(coords) == 0:
+        return []
+    _, _, starts, ends = sweep_groups(coords)
+    return np.column_stack((starts, ends)).tolist()
+
+
+# #### Function that merges new coordinates into the existing CNEs of a species (--incremental)
+# numbers, starts, ends: existing CNEs without cne_0
+# Returns numbers, starts, ends of all CNEs (sorted by number) and a data frame of changes (see Output)
+@profiled
+def update_species_cnes(species, numbers, starts, ends, new_coords, last_number=0):
+    import pandas as pd
+    coords = np.concatenate((np.column_stack((starts, ends)), new_coords.astype(np.int64)))
+    # New coordinates have number 0
+    row_numbers = np.concatenate((numbers, np.zeros(len(new_coords), dtype=np.int64)))
+    order, groups, group_starts, group_ends = sweep_groups(coords)
+    coords = coords[order]
+    row_numbers = row_numbers[order]
+    existing = row_numbers > 0
+    # Each group keeps the smallest number of its existing CNEs, groups of new coordinates only are new CNEs
+    no_number = np.iinfo(np.int64).max
+    group_numbers = np.full(len(group_starts), no_number, dtype=np.int64)
+    np.minimum.at(group_numbers, groups[existing], row_numbers[existing])
+    new_cnes = group_numbers == no_number
+    # Numbers of CNEs merged by previous runs are not used again
+    last_number = max(last_number, numbers.max() if len(numbers) else 0)
+    group_numbers[new_cnes] = last_number + 1 + np.arange(new_cnes.sum())
+    kept = existing & (row_numbers == group_numbers[groups])
+    extended = kept & ((coords[:, 0] != group_starts[groups]) | (coords[:, 1] != group_ends[groups]))
+    merged = existing & ~kept
+
+    def cne_ids(cne_numbers):
+        return [species + "_cne_" + str(number) for number in cne_numbers.tolist()]
+
+    changes = pd.concat([
+        pd.DataFrame({'cne_id': cne_ids(group_numbers[new_cnes]), 'change': 'new', 'merged_into': '',
+                      'start': group_starts[new_cnes], 'end': group_ends[new_cnes]}),
+        pd.DataFrame({'cne_id': cne_ids(row_numbers[extended]), 'change': 'extended', 'merged_into': '',
+                      'old_start': coords[extended, 0], 'old_end': coords[extended, 1],
+                      'start': group_starts[groups[extended]], 'end': group_ends[groups[extended]]}),
+        pd.DataFrame({'cne_id': cne_ids(row_numbers[merged]), 'change': 'merged',
+                      'merged_into': cne_ids(group_numbers[groups[merged]]),
+                      'old_start': coords[merged, 0], 'old_end': coords[merged, 1],
+                      'start': group_starts[groups[merged]], 'end': group_ends[groups[merged]]})])
+    by_number = np.argsort(group_numbers)
+    return group_numbers[by_number], group_starts[by_number], group_ends[by_number], changes
+
+
+# #### Function that appends the changes of CNE IDs of an --incremental run to cne_id_changes.tsv
+# Changes are appended: merge_all_links.py may run once after several --incremental runs
+def write_cne_id_changes(all_changes, run):
+    import pandas as pd
+    changes = pd.concat(all_changes)
+    changes.insert(0, 'run', run)
+    changes_exist = exists('cne_id_changes.tsv')
+    changes.to_csv('cne_id_changes.tsv', sep='\t', index=False, mode='a', header=not changes_exist,
+                   columns=['run', 'cne_id', 'change', 'merged_into', 'old_start', 'old_end', 'start', 'end'],
+                   float_format='%.0f')
+
+
+# #### Function that writes the coordinates of the CNEs of a species: cne_id, start, end
+def write_cne_coords(species, cne_ids, starts, ends):
+    import pandas as pd
+    df = pd.DataFrame({'start': starts, 'end': ends}, index=cne_ids)
+    with open_file(output_name(species + "_cne_coords.tsv"), 'wt') as coords_file:
+        df.to_csv(coords_file, sep='\t', header=False)
 
 
 # #### Parse each cnefinder output file
 for file in cne_files:
     print("Processing cne file: ", file)
-    species = file.split(".out")[0].split("_vs_")
-    comp = pd.read_csv(working_dir + file, sep = "\t")#, names = column_names)
-    parse_pairwise_comps(species, comp)
+    species = cf_species(working_dir + file)
+    # Read file in batches of rows, only coordinates are kept in memory
+    with stage_metrics("read_cnefinder", input_file=working_dir + file) as metrics:
+        for comp in read_cf_batches(working_dir + file, columns=coord_columns):
+            parse_pairwise_comps(species, comp)
+            metrics['rows'] += len(comp)
+        metrics['bytes'] = getsize(working_dir + file)
     print("file ", file, "processed")
 
 
-# #### Create dictionary of all cnes with extended coordinates
-print("Extending CNE coordinates")
-all_species_cne_dict_merged = {}
-for species, species_dict in all_species_cne_dict.items():
-    merged_species_dict = extend_cne_coords(species_dict)
-    all_species_cne_dict_merged[species] = merged_species_dict
-
-
-# #### Recursively merge CNEs with new overlaps
-# Overlapping cnes were generated sequentially.  
-# As a result, cnes that were not overlapping may now overlap.  
-# cnes need to be merged recursively to avoid this problem.  
-
-print("Recursively merging CNEs with new overlaps")
+# #### Update existing CNEs (--incremental)
+# Species of the new files are updated, the CNEs of the other species are copied from the existing table.
+# Codes are converted to the species table that includes the new species.
+
+if args.incremental:
+    old_species = existing_meta['species']
+    last_numbers = existing_meta.get('last_numbers', {})
+    # Tables written before the numbering was recorded get a numbering ID
+    numbering = existing_meta.get('numbering') or uuid.uuid4().hex
+    run = existing_meta.get('run', 0) + 1
+    species_list = species_table(set(old_species) | set(all_species_coords))
+    existing_species = np.asarray(existing_cnes['species'])
+    _, existing_numbers = decode_cne_id(existing_cnes['cne'])
+    table_species, table_numbers, table_starts, table_ends = [], [], [], []
+    all_changes = []
+    updated_cnes = {}
+    for species_idx, species in enumerate(species_list):
+        rows = existing_species == old_species.index(species) if species in old_species else []
+        numbers = existing_numbers[rows]
+        starts = np.asarray(existing_cnes['start'])[rows]
+        ends = np.asarray(existing_cnes['end'])[rows]
+        if species in all_species_coords:
+            print("Updating CNEs of:", species)
+            with stage_metrics("merge_cnes", input_file=species) as metrics:
+                # cne_0 is the placeholder [0, 0]
+                cnes = numbers > 0
+                numbers, starts, ends, changes = update_species_cnes(species, numbers[cnes], starts[cnes], ends[cnes],
+                                                                     np.concatenate(all_species_coords[species]),
+                                                                     last_numbers.get(species, 0))
+                numbers = np.append(0, numbers)
+                starts = np.append(0, starts)
+                ends = np.append(0, ends)
+                all_changes.append(changes)
+                updated_cnes[species] = (numbers, starts, ends)
+                last_numbers[species] = int(max(numbers.max(), last_numbers.get(species, 0)))
+                metrics['rows'] = sum(len(coords) for coords in all_species_coords[species])
+            print(species, ":", changes['change'].value_counts().to_dict())
+        table_species.append(np.full(len(numbers), species_idx, dtype=np.int32))
+        table_numbers.append(numbers)
+        table_starts.append(starts)
+        table_ends.append(ends)
+
+    print("Write dictionary to file")
+    with stage_metrics("write_cne_dict") as metrics:
+        table_species = np.concatenate(table_species)
+        columns = {'species': table_species, 'cne': encode_cne_id(table_species, np.concatenate(table_numbers)),
+                   'start': np.concatenate(table_starts).astype(np.int64),
+                   'end': np.concatenate(table_ends).astype(np.int64)}
+        write_table(cne_table, columns, {'kind': 'cne_dict', 'species': species_list, 'cf_files': all_cne_files,
+                                         'numbering': numbering, 'run': run, 'last_numbers': last_numbers})
+        with open('unique_non_overlap_cnes.txt', 'w') as file:
+            file.write(json.dumps(cne_dict_from_table(columns, species_list)))
+        metrics['rows'] = len(table_species)
+
+    write_cne_id_changes(all_changes, run)
+    print("CNE ID changes of run", run, "added to: cne_id_changes.tsv")
+
+    print("Write cne coordinates for downstream analysis")
+    for species, (numbers, starts, ends) in updated_cnes.items():
+        write_cne_coords(species, [species + "_cne_" + str(number) for number in numbers.tolist()], starts, ends)
+    print("All done, Bye")
+    sys.exit()
+
+
+# #### Merge overlapping CNEs
+# cne_0 is kept as placeholder [0, 0] for each species, merged cnes are numbered from 1 by start coordinate
+
+print("Merging overlapping CNEs")
 unique_non_overlap_cnes = {}
-for species, species_dict in all_species_cne_dict_merged.items():
-    unique_non_overlap_cnes[species] = {}
-    coord_list =  sorted(list(species_dict.values()))
-    merged_list = recursive_merge(coord_list)
-    for i in range(len(merged_list)):
-        cne_id = species + "_cne_" + str(i)
-        unique_non_overlap_cnes[species][cne_id] = merged_list[i]
+for species, coord_list in all_species_coords.items():
+    with stage_metrics("merge_cnes", input_file=species) as metrics:
+        unique_non_overlap_cnes[species] = {species + "_cne_0": [0, 0]}
+        if coord_list:
+            merged_list = sweep_merge(np.concatenate(coord_list))
+        else:
+            merged_list = []
+        for i in range(len(merged_list)):
+            cne_id = species + "_cne_" + str(i + 1)
+            unique_non_overlap_cnes[species][cne_id] = merged_list[i]
+        metrics['rows'] = sum(len(coords) for coords in coord_list)
 
 
 # #### Write dictionary of non-overlapping CNEs to file
 
 print("Write dictionary to file")
 # Write dictionary of non-overlapping, unique cnes to file
-with open('unique_non_overlap_cnes.txt', 'w') as file:
-     file.write(json.dumps(unique_non_overlap_cnes)) # use 'json.loads' to do the reverse
+with stage_metrics("write_cne_dict") as metrics:
+    with open('unique_non_overlap_cnes.txt', 'w') as file:
+         file.write(json.dumps(unique_non_overlap_cnes)) # use 'json.loads' to do the reverse
+    last_numbers = {species: len(cnes) - 1 for species, cnes in unique_non_overlap_cnes.items()}
+    write_cne_table(cne_table, unique_non_overlap_cnes, {'cf_files': all_cne_files, 'numbering': uuid.uuid4().hex,
+                                                         'run': 0, 'last_numbers': last_numbers})
+    # CNEs were numbered again: changes of a previous --incremental run do not apply
+    if exists('cne_id_changes.tsv'):
+        remove('cne_id_changes.tsv')
+    metrics['rows'] = sum(len(cnes) for cnes in unique_non_overlap_cnes.values())
+    metrics['bytes'] = getsize('unique_non_overlap_cnes.txt')
 
 
 # #### Write cne coordinates to file for downstream analysis
@@ -177,9 +331,7 @@ with open('unique_non_overlap_cnes.txt', 'w') as file:
 print("Write cne coordinates for downstream analysis")
 # Write file of cne coordinates for each species
 for species, cnes in unique_non_overlap_cnes.items():
-    file_name = species + "_cne_coords.tsv"
-    df = pd.DataFrame.from_dict(cnes,'index')
-    df.to_csv(file_name, sep='\t', header = False)
+    write_cne_coords(species, list(cnes), [coords[0] for coords in cnes.values()], [coords[1] for coords in cnes.values()])
 
 print("All done, Bye")
 
@@ -0,0 +1,170 @@
+# # make_synthetic_data.py
+
+# ## Usage
+#
+# make_synthetic_data.py out_dir [--species 4] [--cnes 10000] [--overlap-density 0.5] [--scaffolds 100]
+#                        [--genome-size 5000000] [--blast-hits 10000] [--seed 1] [--compress gz|bgz]
+#
+# ## Goal
+#
+# Create synthetic inputs for all stages of the pipeline, used by benchmark_pipeline.py.
+# Each species has a genome of random scaffolds padded with 100 Ns (as pad_scaffolds does).
+# Each pair of species has a CNEFinder output file. A fraction of the CNEs (overlap density) is placed at
+# loci shared by all comparisons of a species, so that CNEs overlap between CNEFinder files and form
+# three-way links and clusters, the other CNEs are placed at random.
+#
+# ## Output (in out_dir)
+#
+# cnefinder/ref_vs_query.out: CNEFinder output files (9 columns, coordinates on the concatenated padded scaffolds)
+# genomes/species_pad.fa: padded FASTA files
+# blastn/query_combined_cnes_vs_subject.blastn: Blastn results (outfmt 6) of CNEs of each species against the others
+# tree.nwk: random rooted tree of all species, internal nodes named node_1, node_2, etc
+# With --compress, CNEFinder, FASTA and Blastn files are compressed (extension .gz or .bgz, see cne_io.py)
+#
+# ***
+
+import argparse
+import os
+from itertools import combinations
+from os.path import join
+from cne_io import open_file
+
+# #### Species names: species of parsimony_analysis_part1_with_blast.py, then sp14, sp15, etc
+species_list = ['dgig', 'ofav', 'pdam', 'spis', 'adig', 'nvec', 'epal', 'aten', 'mvir', 'aaur', 'chem', 'hvul', 'hsym']
+
+pad_length = 100
+line_width = 60
+jitter = 20
+min_cne_length = 50
+max_cne_length = 300
+
+parser = argparse.ArgumentParser()
+parser.add_argument("out_dir")
+parser.add_argument("--species", type=int, default=4, help="number of species")
+parser.add_argument("--cnes", type=int, default=10000, help="number of CNEs per CNEFinder file")
+parser.add_argument("--overlap-density", type=float, default=0.5,
+                    help="fraction of CNEs placed at loci shared by all comparisons of a species")
+parser.add_argument("--scaffolds", type=int, default=100, help="number of scaffolds per genome")
+parser.add_argument("--genome-size", type=int, default=5000000, help="genome size (bp) per species")
+parser.add_argument("--blast-hits", type=int, default=10000, help="number of Blastn hits per species pair")
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--compress", choices=["gz", "bgz"], help="compress CNEFinder, FASTA and Blastn files")
+args = parser.parse_args()
+
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+# pandas is imported by write_tsv
+import numpy as np
+from stage_metrics import startup_check
+startup_check()
+
+rng = np.random.default_rng(args.seed)
+species = (species_list + ["sp" + str(i) for i in range(len(species_list) + 1, args.species + 1)])[:args.species]
+for directory in ["cnefinder", "genomes", "blastn"]:
+    os.makedirs(join(args.out_dir, directory), exist_ok=True)
+
+
+def compressed(path):
+    return path + "." + args.compress if args.compress else path
+
+
+# #### Function that writes a table (dictionary of column name: values) to a tab-separated file
+def write_tsv(file_name, table, **options):
+    import pandas as pd
+    with open_file(compressed(file_name), 'wt') as tsv:
+        pd.DataFrame(table).to_csv(tsv, sep="\t", index=False, **options)
+
+
+# #### Genomes
+# scaffold_ends: end of the sequence of each scaffold (without Ns) on the concatenated padded scaffolds
+def write_genome(sp):
+    mean_length = max(args.genome_size // args.scaffolds, max_cne_length + 1)
+    lengths = rng.integers(max(mean_length // 2, max_cne_length + 1), mean_length * 3 // 2 + 1, args.scaffolds)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    with open_file(compressed(join(args.out_dir, "genomes", sp + "_pad.fa")), 'wb') as fasta:
+        for i, length in enumerate(lengths):
+            sequence = bases[rng.integers(0, 4, length)].tobytes() + b"N" * pad_length
+            fasta.write(b">" + (sp + "_scaffold_" + str(i + 1)).encode() + b"\n")
+            fasta.write(b"\n".join(sequence[j:j + line_width] for j in range(0, len(sequence), line_width)) + b"\n")
+    padded_ends = np.cumsum(lengths + pad_length)
+    return padded_ends - pad_length, lengths
+
+
+# #### Function that draws random CNE loci: start coordinates on the concatenated padded scaffolds
+# Loci are drawn in the sequence of a scaffold, far enough from its end to hold the longest CNE
+def random_loci(scaffold_ends, scaffold_lengths, n):
+    usable = scaffold_lengths - max_cne_length
+    cumul = np.cumsum(usable)
+    positions = rng.integers(0, cumul[-1], n)
+    scaffold = np.searchsorted(cumul, positions, side='right')
+    return scaffold_ends[scaffold] - scaffold_lengths[scaffold] + (positions - (cumul[scaffold] - usable[scaffold])), scaffold
+
+
+# #### Function that places CNEs of one species of a CNEFinder file
+# Shared CNEs start near a shared locus of the species, the others at a random locus
+def place_cnes(sp, n):
+    starts, scaffold = random_loci(genomes[sp][0], genomes[sp][1], n)
+    shared = rng.random(n) < args.overlap_density
+    pick = rng.integers(0, len(shared_loci[sp][0]), shared.sum())
+    starts[shared] = shared_loci[sp][0][pick] + rng.integers(-jitter, jitter + 1, shared.sum())
+    scaffold[shared] = shared_loci[sp][1][pick]
+    scaffold_starts = genomes[sp][0][scaffold] - genomes[sp][1][scaffold]
+    starts = np.clip(starts, scaffold_starts, genomes[sp][0][scaffold] - max_cne_length)
+    ends = starts + rng.integers(min_cne_length, max_cne_length + 1, n)
+    return starts, ends
+
+
+genomes = {}
+shared_loci = {}
+for sp in species:
+    print("Writing genome:", sp)
+    genomes[sp] = write_genome(sp)
+    shared_loci[sp] = random_loci(genomes[sp][0], genomes[sp][1], max(args.cnes // 2, 1))
+
+
+# #### CNEFinder output files
+for ref, query in combinations(species, 2):
+    print("Writing CNEFinder file:", ref + "_vs_" + query + ".out")
+    ref_starts, ref_ends = place_cnes(ref, args.cnes)
+    query_starts, query_ends = place_cnes(query, args.cnes)
+    write_tsv(join(args.out_dir, "cnefinder", ref + "_vs_" + query + ".out"), {ref + '_chrom': ref + "_genome", ref + '_start': ref_starts, ref + '_end': ref_ends,
+              query + '_chrom': query + "_genome", query + '_start': query_starts,
+              query + '_end': query_ends, 'ref_length': ref_ends - ref_starts,
+              'query_length': query_ends - query_starts,
+              'sim': np.round(rng.uniform(0.9, 1.0, args.cnes), 4)})
+
+
+# #### Blastn results
+# Query IDs are drawn from the CNE numbers generate_cne_ids.py can create for the species
+blast_columns = ['query_id', 'subject_id', 'pct_identity', 'aln_length', 'n_of_mismatches', 'gap_openings',
+                 'q_start', 'q_end', 's_start', 's_end', 'e_value', 'bit_score']
+max_cne_number = max(args.cnes * (args.species - 1), 1)
+for query in species:
+    for subject in species:
+        if subject == query:
+            continue
+        n = args.blast_hits
+        aln_length = rng.integers(min_cne_length, max_cne_length + 1, n)
+        s_start = rng.integers(1, args.genome_size, n)
+        hits = {'query_id': [query + "_cne_" + str(number) for number in rng.integers(1, max_cne_number + 1, n)],
+                'subject_id': [subject + "_scaffold_" + str(i) for i in rng.integers(1, args.scaffolds + 1, n)],
+                'pct_identity': np.round(rng.uniform(70, 100, n), 3), 'aln_length': aln_length,
+                'n_of_mismatches': rng.integers(0, 20, n), 'gap_openings': rng.integers(0, 3, n),
+                'q_start': 1, 'q_end': aln_length, 's_start': s_start, 's_end': s_start + aln_length - 1,
+                'e_value': 10.0 ** -rng.uniform(-1, 40, n), 'bit_score': np.round(rng.uniform(30, 500, n), 1)}
+        write_tsv(join(args.out_dir, "blastn", query + "_combined_cnes_vs_" + subject + ".blastn"), hits,
+                  header=False, columns=blast_columns, float_format="%.3g")
+
+
+# #### Tree: random rooted binary tree, joining random pairs of subtrees
+subtrees = list(species)
+node_counter = 0
+while len(subtrees) > 1:
+    i, j = sorted(rng.choice(len(subtrees), 2, replace=False), reverse=True)
+    node_counter += 1
+    joined = "(" + subtrees[i] + "," + subtrees[j] + ")node_" + str(node_counter)
+    del subtrees[i], subtrees[j]
+    subtrees.append(joined)
+with open(join(args.out_dir, "tree.nwk"), 'w') as tree:
+    tree.write(subtrees[0] + ";\n")
+
+print("Done. Synthetic data in:", args.out_dir)
@@ -1,65 +1,166 @@
-import json
+import argparse
 import csv
 import glob
-from collections import defaultdict
+import os
+import sys
+from os.path import exists, isdir, join
+from cne_io import glob_files, strip_compression
 
-pairwise_file = 'pairwise_links.json'
+# #### User input
+# --incremental: clusters of the previous run are loaded from the state file (--state), only link files that are
+# new or changed since the previous run are added. Links are only added: links removed from a file are not undone.
+# The state file is written in both modes, with the numbering of the CNE IDs of the dictionary (--cne-dict):
+# --incremental stops if generate_cne_ids.py numbered the CNEs again since the previous run.
+# CNE IDs merged by generate_cne_ids.py --incremental (cne_id_changes.tsv, all runs since the last full run) are
+# clustered with the CNE they were merged into, and left out of the clusters.
+parser = argparse.ArgumentParser()
+parser.add_argument("--incremental", action="store_true", help="update the clusters of the previous run")
+parser.add_argument("--state", default="cne_clusters.state", help="clusters of the previous run")
+parser.add_argument("--changes", default="cne_id_changes.tsv", help="CNE ID changes of generate_cne_ids.py")
+parser.add_argument("--cne-dict", default="unique_non_overlap_cnes.cnes", help="CNE table of generate_cne_ids.py")
+args = parser.parse_args()
+
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+from disjoint_set import DisjointSet, read_links
+from cne_store import read_links as read_links_table, read_table, is_table
+import cne_ids
+from stage_metrics import stage_metrics, startup_check
+startup_check()
+
+pairwise_file = 'pairwise_links.links'
 threeway_dir = "threeway_links/"
 
-threeway_files = glob.glob(threeway_dir + "*json")
-
-# #### Function that merges all sublists having common elements.
-def merge_common(lists):
-    neigh = defaultdict(set)
-    visited = set()
-    for each in lists:
-        for item in each:
-            neigh[item].update(each)
-    def comp(node, neigh = neigh, visited = visited, vis = visited.add):
-        nodes = set([node])
-        next_node = nodes.pop
-        while nodes:
-            node = next_node()
-            vis(node)
-            nodes |= neigh[node] - visited
-            yield node
-    for node in neigh:
-        if node not in visited:
-            yield sorted(comp(node))
+# Links written before integer CNE IDs were introduced
+if not isdir(pairwise_file):
+    pairwise_file = 'pairwise_links.json'
+
+# Columnar tables (.links), and json links of overlap files that have no table (written by older versions)
+threeway_files = sorted(glob.glob(threeway_dir + "*.links"))
+table_names = {links_file[:-len(".links")] for links_file in threeway_files}
+threeway_files += sorted(json_file for json_file in glob_files(threeway_dir + "*.json")
+                         if strip_compression(json_file)[:-len(".json")] not in table_names)
+
+# #### Union-find structure of all CNEs
+# Links are added one at a time, CNEs linked directly or indirectly end up in the same cluster
+# CNEs are identified by their integer ID (see cne_ids.py)
+# Species table shared by all link files, species missing from the table are added at the end
+# link_files: size and modification time of the link files already added
+# numbering: numbering of the CNE IDs (see generate_cne_ids.py), None for dictionaries without numbering
+numbering = read_table(args.cne_dict)[1].get('numbering') if is_table(args.cne_dict) else None
+if args.incremental:
+    if not exists(args.state):
+        sys.exit("No clusters to update: " + args.state)
+    cne_clusters, state = DisjointSet.load(args.state)
+    if state.get('numbering') != numbering:
+        sys.exit("CNE IDs of " + args.cne_dict + " were numbered again since the clusters of " + args.state
+                 + " were saved, run merge_all_links.py without --incremental")
+    species = state['species']
+    link_files = state['link_files']
+    retired = set(state['retired'])
+else:
+    cne_clusters = DisjointSet()
+    species = []
+    link_files = {}
+    retired = set()
+species_index = {sp: i for i, sp in enumerate(species)}
+
+
+# #### Function that returns the size and modification time of a link file (or table directory)
+def fingerprint(links_file):
+    if isdir(links_file):
+        stats = [os.stat(join(links_file, name)) for name in sorted(os.listdir(links_file))]
+    else:
+        stats = [os.stat(links_file)]
+    return [sum(stat.st_size for stat in stats), max(stat.st_mtime_ns for stat in stats)]
+
+
+def add_species(sp):
+    if sp not in species_index:
+        species_index[sp] = len(species)
+        species.append(sp)
+
+
+# #### Function that adds all links of a file to the clusters
+# Returns the number of links
+def add_links_file(links_file):
+    if links_file.endswith(".links"):
+        cne_codes, link_offsets, file_species = read_links_table(links_file)
+        for sp in file_species:
+            add_species(sp)
+        cne_codes = cne_ids.recode_cne_ids(cne_codes, file_species, species).tolist()
+        link_offsets = link_offsets.tolist()
+        for link_start, link_end in zip(link_offsets[:-1], link_offsets[1:]):
+            cne_clusters.add_link(cne_codes[link_start:link_end])
+        return len(link_offsets) - 1
+    number_of_links = 0
+    for link in read_links(links_file):
+        for cne_id in link:
+            add_species(cne_ids.cne_species(cne_id))
+        cne_clusters.add_link([cne_ids.cne_id_to_code(cne_id, species_index) for cne_id in link])
+        number_of_links += 1
+    return number_of_links
+
+
+# #### Function that adds the links of a file unless they were added by the previous run
+def update_links_file(links_file):
+    file_fingerprint = fingerprint(links_file)
+    if link_files.get(links_file) == file_fingerprint:
+        return
+    with stage_metrics("add_links", input_file=links_file) as metrics:
+        metrics['rows'] = add_links_file(links_file)
+    link_files[links_file] = file_fingerprint
 
 
 # #### Read pairwise_links
 print("reading list of pairwise CNEs")
-with open(pairwise_file) as json_file:
-    pairwise_links = json.load(json_file)
+update_links_file(pairwise_file)
 
 
 # #### Read all threeway links
 print("reading threeway links. Number of files: ", len(threeway_files) )
-all_threeway_links = []
 counter = 0
 for file in threeway_files:
     if counter % 10 == 0:
         print(counter, " files processed.")  
-    with open(file) as json_file:
-        threeway_links = json.load(json_file)
-        all_threeway_links = all_threeway_links + threeway_links
-        counter = counter + 1
-#### Combine pairwise and threeway links
-print("Combining links")
-all_cne_links = pairwise_links + all_threeway_links
+    update_links_file(file)
+    counter = counter + 1
+
+
+# #### CNE IDs merged by generate_cne_ids.py --incremental
+# Links of the previous runs may contain merged CNE IDs: they join the cluster of the CNE they were merged into
+if exists(args.changes):
+    print("reading CNE ID changes:", args.changes)
+    with open(args.changes) as changes_file:
+        for change in csv.DictReader(changes_file, delimiter="\t"):
+            if change['change'] != 'merged':
+                continue
+            for cne_id in (change['cne_id'], change['merged_into']):
+                add_species(cne_ids.cne_species(cne_id))
+            code = cne_ids.cne_id_to_code(change['cne_id'], species_index)
+            retired.add(code)
+            if code in cne_clusters.cne_ids:
+                cne_clusters.add_link([code, cne_ids.cne_id_to_code(change['merged_into'], species_index)])
+
+with stage_metrics("save_state", input_file=args.state):
+    cne_clusters.save(args.state, {'species': species, 'link_files': link_files, 'retired': sorted(retired),
+                                   'numbering': numbering})
 
 
 #### Merge all links
-print("Merging homologous clusters, this may take some time")
-merged_list = list(merge_common(all_cne_links))
-print("Merging done. Number of clusters: ", len(merged_list))
+print("Merging homologous clusters")
+merged_list = cne_clusters.clusters(format_id=lambda code: cne_ids.code_to_cne_id(code, species))
+if retired:
+    retired_ids = {cne_ids.code_to_cne_id(code, species) for code in retired}
+    merged_list = ([cne_id for cne_id in cluster if cne_id not in retired_ids] for cluster in merged_list)
 
 
 # #### Write to file for downstream analyses
 print("Writing CNE clusters to file: merged_cne_clusters.csv")
-with open("merged_cne_clusters.csv","w") as f:
+number_of_clusters = 0
+with stage_metrics("clusters") as metrics, open("merged_cne_clusters.csv","w") as f:
     wr = csv.writer(f)
-    wr.writerows(merged_list)
-
-
+    for cluster in merged_list:
+        wr.writerow(cluster)
+        number_of_clusters += 1
+    metrics['rows'] = number_of_clusters
+print("Merging done. Number of clusters: ", number_of_clusters)
@@ -1,33 +1,93 @@
+import argparse
 import glob
-import json
 import sys
+from collections import deque
+from cne_io import glob_files
+from concurrent.futures import ThreadPoolExecutor
 
-overlap_dir = sys.argv[1]
-output_file_name = sys.argv[2]
+parser = argparse.ArgumentParser()
+parser.add_argument("overlap_dir")
+parser.add_argument("output_file_name")
+parser.add_argument("--prefetch", type=int, default=0, help="number of files read ahead by background threads")
+args = parser.parse_args()
+overlap_dir = args.overlap_dir
+output_file_name = args.output_file_name
+
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+import numpy as np
+from cne_store import read_overlap_table, read_overlap_species, write_overlap_chunks
+from stage_metrics import stage_metrics, startup_check
+startup_check()
 
 #overlap_dir = "adig_spis_pdam_spis_split/"
 #output_file_name = "spis_overlap_adig_pdam.txt"
+# Output is a json dictionary if output_file_name ends with .txt or .json, JSON Lines if it ends with .jsonl
+# (compressed if followed by .gz or .bgz, e.g. spis_overlap_adig_pdam.jsonl.gz), a columnar table otherwise (e.g. spis_overlap_adig_pdam.overlaps, see cne_store.py)
+# Files are read one at a time (or --prefetch files ahead) and written as they are read:
+# memory is bounded by the largest files, not by the merged output.
 
 
 # #### List dictionaries
 
-overlap_files = [f for f in glob.glob(overlap_dir + "*.txt")]
+overlap_files = (glob_files(overlap_dir + "*.txt") + glob_files(overlap_dir + "*.jsonl")
+                 + [f for f in glob.glob(overlap_dir + "*.overlaps")])
 print("Found ", len(overlap_files), " files in : ", overlap_dir)
 
-counter = 1
-all_overlaps = {}
+# #### Check that all files have the same species (columns can be in a different order)
+# Files without overlaps are skipped
+all_species = None
 for overlap_file in overlap_files:
-    with open(overlap_file) as json_file:
-        overlap_dict = json.load(json_file)
-    print(len(overlap_dict))
-    for cne_id, coord_dict in overlap_dict.items():
-        new_id = cne_id.split("_cne_")[0] + "_cne_" + str(counter)
-        all_overlaps[new_id] = coord_dict
-        counter += 1
+    species = read_overlap_species(overlap_file)
+    if not species:
+        continue
+    if all_species is None:
+        all_species, first_file = species, overlap_file
+    elif set(species) != set(all_species):
+        sys.exit("Overlap files with different species: " + first_file + " (" + ", ".join(all_species) + "), "
+                 + overlap_file + " (" + ", ".join(species) + ")")
+
+
+def read_overlap_file(overlap_file):
+    with stage_metrics("read_overlaps", input_file=overlap_file) as metrics:
+        overlaps = read_overlap_table(overlap_file)
+        metrics['rows'] = len(overlaps[1])
+    return overlaps
 
-print("writing output file:", output_file_name)
-with open(output_file_name, 'w') as outfile:
-    json.dump(all_overlaps, outfile)
-print("Done, bye.")
 
+# #### Function that yields the overlaps of each file, in the order of overlap_files
+# With prefetch, the next files are read by background threads while the current one is written
+def read_overlap_files(overlap_files, prefetch):
+    if prefetch <= 0:
+        for overlap_file in overlap_files:
+            yield read_overlap_file(overlap_file)
+        return
+    with ThreadPoolExecutor(prefetch) as executor:
+        pending = deque()
+        for overlap_file in overlap_files:
+            pending.append(executor.submit(read_overlap_file, overlap_file))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
+
+# #### Function that renumbers the overlaps of all files from 1
+# Same column order for all files: species order of the first file with overlaps
+def renumber_overlaps(overlaps):
+    counter = 1
+    all_species = None
+    for species, numbers, starts, ends in overlaps:
+        if len(numbers) == 0:
+            continue
+        if all_species is None:
+            all_species = species
+        columns = [species.index(sp) for sp in all_species]
+        yield all_species, np.arange(counter, counter + len(numbers)), starts[:, columns], ends[:, columns]
+        counter += len(numbers)
+
+
+print("writing output file:", output_file_name)
+with stage_metrics("write_overlaps", input_file=output_file_name) as metrics:
+    metrics['rows'] = write_overlap_chunks(output_file_name,
+                                           renumber_overlaps(read_overlap_files(overlap_files, args.prefetch)))
+print("Done, bye.")
@@ -0,0 +1,176 @@
+# # overlap_join.py
+
+# ## Goal
+#
+# Find all overlapping CNEs between two pairwise comparisons that have a species in common.
+# Intervals of the second comparison are sorted once on the common species coordinates,
+# intervals of the first comparison are then searched in batches with binary search.
+# Replaces the nested iterrows loops of calculate_overlaps_split.py.
+#
+# ## Usage
+#
+# common_cnes = find_common_cnes(common_species, (starts_1, ends_1), (starts_2, ends_2),
+#                                specific_comp1, (spec_starts_1, spec_ends_1),
+#                                specific_comp2, (spec_starts_2, spec_ends_2))
+# species, starts, ends = overlap_cf_files(file1, file2)
+# for file1, file2, species, starts, ends in overlap_cf_dir(cf_files):
+#
+# ***
+
+import numpy as np
+from itertools import combinations
+from cne_index import overlap_candidates
+from cne_store import overlaps_to_dict
+from cf_reader import cf_species, read_cf_batches, read_cf_file
+from stage_metrics import profiled
+
+
+# #### Function that sorts one comparison on the common species coordinates
+def sort_comparison(starts, ends):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    sorted_ends = ends[order]
+    return {'order': order,
+            'start': starts[order],
+            'end': sorted_ends,
+            'max_end': np.maximum.accumulate(sorted_ends) if len(order) else sorted_ends}
+
+
+# #### Function that finds all pairs of overlapping intervals
+# Overlap test is the same as check_overlap: both intervals share at least one position.
+# sorted_comp2 can be given when the second comparison was already sorted with sort_comparison.
+# Returns row indices in comparison 1 and comparison 2, ordered by row of comparison 1 then row of comparison 2
+@profiled
+def overlap_join(starts_1, ends_1, starts_2=None, ends_2=None, sorted_comp2=None, batch_size=1000000):
+    if sorted_comp2 is None:
+        sorted_comp2 = sort_comparison(starts_2, ends_2)
+    starts_1 = np.asarray(starts_1, dtype=np.int64)
+    ends_1 = np.asarray(ends_1, dtype=np.int64)
+    rows_1 = []
+    rows_2 = []
+    # Batches of comparison 1 keep memory bounded for very large files
+    for batch_start in range(0, len(starts_1), batch_size):
+        batch_end = batch_start + batch_size
+        query_idx, sorted_idx = overlap_candidates(sorted_comp2, starts_1[batch_start:batch_end],
+                                                   ends_1[batch_start:batch_end])
+        batch_rows_2 = sorted_comp2['order'][sorted_idx]
+        order = np.lexsort((batch_rows_2, query_idx))
+        rows_1.append(query_idx[order] + batch_start)
+        rows_2.append(batch_rows_2[order])
+    if not rows_1:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(rows_1), np.concatenate(rows_2)
+
+
+# #### Function that creates the coordinates of common CNEs
+# One row per overlapping pair, in the same order as the nested loops over file 1 and file 2.
+# Coordinates of the common species are extended to include both CNEs.
+# Returns starts and ends arrays of shape (number of overlaps, 3): common species, specific 1, specific 2
+def find_common_cne_coords(common_coords_1, common_coords_2, specific_coords_1, specific_coords_2, sorted_comp2=None):
+    common_starts_1, common_ends_1 = (np.asarray(coords, dtype=np.int64) for coords in common_coords_1)
+    common_starts_2, common_ends_2 = (np.asarray(coords, dtype=np.int64) for coords in common_coords_2)
+    rows_1, rows_2 = overlap_join(common_starts_1, common_ends_1, common_starts_2, common_ends_2,
+                                  sorted_comp2=sorted_comp2)
+    starts = np.column_stack((np.minimum(common_starts_1[rows_1], common_starts_2[rows_2]),
+                              np.asarray(specific_coords_1[0], dtype=np.int64)[rows_1],
+                              np.asarray(specific_coords_2[0], dtype=np.int64)[rows_2]))
+    ends = np.column_stack((np.maximum(common_ends_1[rows_1], common_ends_2[rows_2]),
+                            np.asarray(specific_coords_1[1], dtype=np.int64)[rows_1],
+                            np.asarray(specific_coords_2[1], dtype=np.int64)[rows_2]))
+    return starts, ends
+
+
+# #### Function that creates the dictionary of common CNEs
+# Same dictionary as the nested loops: one entry per overlapping pair, numbered from first_id
+# {"spis_cne_1": {"spis": "start:end", "pdam": "start:end", "adig": "start:end"}, ...}
+def find_common_cnes(common_species, common_coords_1, common_coords_2,
+                     specific_comp1, specific_coords_1, specific_comp2, specific_coords_2,
+                     first_id=1, sorted_comp2=None):
+    starts, ends = find_common_cne_coords(common_coords_1, common_coords_2, specific_coords_1, specific_coords_2,
+                                          sorted_comp2)
+    numbers = np.arange(first_id, first_id + len(starts))
+    return overlaps_to_dict([common_species, specific_comp1, specific_comp2], numbers, starts, ends)
+
+
+# #### Function that identifies common and specific species of two comparisons
+# Returns common species, species specific to comparison 1, species specific to comparison 2
+def comparison_species(comp1, comp2):
+    for species in comp1:
+        if species in comp2:
+            common_species = species
+        else:
+            specific_comp1 = species
+    for species in comp2:
+        if species not in comp1:
+            specific_comp2 = species
+    return common_species, specific_comp1, specific_comp2
+
+
+# #### Function that returns the coordinate columns of a species in a comparison
+# Columns depend on whether the species was reference or query (see cf_reader.py)
+def species_columns(species, comp):
+    ref_query = "ref" if comp[0] == species else "query"
+    return [ref_query + '_start', ref_query + '_end']
+
+
+# #### Function that finds common CNEs of two CNEFinder files
+# File 2 is read and sorted on the common species coordinates, file 1 is read in batches.
+# Returns species list [common, specific 1, specific 2] and starts, ends arrays (see find_common_cne_coords)
+def overlap_cf_files(file1, file2):
+    comp1 = cf_species(file1)
+    comp2 = cf_species(file2)
+    common_species, specific_comp1, specific_comp2 = comparison_species(comp1, comp2)
+    common_columns_comp1 = species_columns(common_species, comp1)
+    common_columns_comp2 = species_columns(common_species, comp2)
+    spec_columns_comp1 = species_columns(specific_comp1, comp1)
+    spec_columns_comp2 = species_columns(specific_comp2, comp2)
+    # Only the coordinate columns are kept
+    comp2_cnes = read_cf_file(file2, columns=common_columns_comp2 + spec_columns_comp2)
+    sorted_comp2 = sort_comparison(comp2_cnes[common_columns_comp2[0]], comp2_cnes[common_columns_comp2[1]])
+    common_starts = []
+    common_ends = []
+    for comp1_cnes in read_cf_batches(file1, columns=common_columns_comp1 + spec_columns_comp1):
+        batch_starts, batch_ends = find_common_cne_coords(
+            (comp1_cnes[common_columns_comp1[0]], comp1_cnes[common_columns_comp1[1]]),
+            (comp2_cnes[common_columns_comp2[0]], comp2_cnes[common_columns_comp2[1]]),
+            (comp1_cnes[spec_columns_comp1[0]], comp1_cnes[spec_columns_comp1[1]]),
+            (comp2_cnes[spec_columns_comp2[0]], comp2_cnes[spec_columns_comp2[1]]),
+            sorted_comp2=sorted_comp2)
+        common_starts.append(batch_starts)
+        common_ends.append(batch_ends)
+    common_starts = np.concatenate(common_starts) if common_starts else np.empty((0, 3), dtype=np.int64)
+    common_ends = np.concatenate(common_ends) if common_ends else np.empty((0, 3), dtype=np.int64)
+    return [common_species, specific_comp1, specific_comp2], common_starts, common_ends
+
+
+# #### Function that finds common CNEs of all pairs of CNEFinder files that share one species
+# Files are grouped by common species: each file of a group is read once, and sorted once on the coordinates
+# of the common species, then all pairs of files of the group are joined.
+# Each file is read twice (once per species) instead of once per pair of files.
+# Yields file1, file2 (file1 before file2 in cf_files), species list [common, specific 1, specific 2],
+# starts and ends arrays: same results as overlap_cf_files(file1, file2)
+def overlap_cf_dir(cf_files):
+    comps = {cf_file: cf_species(cf_file) for cf_file in cf_files}
+    for common_species in sorted({sp for comp in comps.values() for sp in comp}):
+        group = [cf_file for cf_file in cf_files if common_species in comps[cf_file] and len(set(comps[cf_file])) == 2]
+        coords = {}
+        sorted_comps = {}
+        for cf_file in group:
+            comp = comps[cf_file]
+            specific_species = [sp for sp in comp if sp != common_species][0]
+            columns = species_columns(common_species, comp) + species_columns(specific_species, comp)
+            cnes = read_cf_file(cf_file, columns=columns)
+            coords[cf_file] = [cnes[column].to_numpy(dtype=np.int64) for column in columns]
+            sorted_comps[cf_file] = sort_comparison(coords[cf_file][0], coords[cf_file][1])
+        for file1, file2 in combinations(group, 2):
+            if len(set(comps[file1]) & set(comps[file2])) != 1:
+                continue
+            common_start_1, common_end_1, spec_start_1, spec_end_1 = coords[file1]
+            common_start_2, common_end_2, spec_start_2, spec_end_2 = coords[file2]
+            starts, ends = find_common_cne_coords((common_start_1, common_end_1), (common_start_2, common_end_2),
+                                                  (spec_start_1, spec_end_1), (spec_start_2, spec_end_2),
+                                                  sorted_comp2=sorted_comps[file2])
+            species = [common_species, [sp for sp in comps[file1] if sp != common_species][0],
+                       [sp for sp in comps[file2] if sp != common_species][0]]
+            yield file1, file2, species, starts, ends
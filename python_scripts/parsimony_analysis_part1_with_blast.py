@@ -1,4 +1,5 @@
-# Usage: parsimony_analysis_part1.py merged_clusters tree blastn_dir
+# Usage: parsimony_analysis_part1.py merged_clusters tree blastn_dir [--workers N] [--blast-cache dir | --no-blast-cache]
+#        [--no-html] [--unique-patterns] [--shards N] [--states-file pastml_states.tsv]
 
 # Goal: run ancestral character state reconstruction tool PASTML to identify potentially convergent CNEs.
 
@@ -7,49 +8,58 @@
 # cnidarian_tree.nwk : phylogenetic tree in Newick format
 # blastn_dir: directory of Blastn results against NCBI nt database. Used to idnetify presence of CNE in other species in the dataset
 ### even when CNEFinder did not find it (e.g. if similarity/length is lower)
+# --blast-cache: directory where filtered Blastn hits are kept between runs (default: blast_cache)
+# --no-html: do not create HTML visualisations, write character states to a table (--states-file) instead
+# --unique-patterns: run pastml once per unique presence/absence pattern instead of once per cluster
+# --shards: split clusters (or patterns) in N shards, run by --workers pastml processes
+# --unique-patterns and --shards imply --no-html
 
 # Output: pastml_output.html, contains dictionary of character states at each node for each CNE. Needs to be parsed
 ### with parsimony_analysis_part2.py
+# With --no-html: pastml_states.tsv, character states at each node (rows) for each cluster (columns),
+### see pastml_states.py. Read by parsimony_analysis_part2 instead of the HTML output.
+### Columnar table if the file name does not end with .tsv (e.g. --states-file pastml_states.states)
 
-from pastml.acr import pastml_pipeline
-import csv
-import itertools
-import pandas as pd
+import argparse
+import os
 import sys
-import pickle
-import ast
-from collections import Counter
-import glob
-from collections import defaultdict
-
-merged_clusters = sys.argv[1]
-tree = sys.argv[2]
-blastn_dir = sys.argv[3]
-blastn_files = glob.glob(blastn_dir + '*.blastn')
-
-# Combine blastn_output and make it searchable by cne_id + subject_id
-combined_df = pd.DataFrame(columns=['query_id','subject_id', 'pct_identity','aln_length', 'n_of_mismatches',
-                 'gap_openings', 'q_start', 'q_end', 's_start', 's_end', 'e_value', 'bit_score',
-                           'query_sp',  'subject_sp'])
-for blastn_file in blastn_files:
-    query_id = blastn_file.split("/")[-1].split('_combined_cnes')[0]
-    subject_id = blastn_file.split("/")[-1].split('_vs_')[1].split(".")[0]
-    sp_blast_df = pd.read_csv(blastn_file, sep="\t", 
-          names=['query_id','subject_id', 'pct_identity','aln_length', 'n_of_mismatches',
-                 'gap_openings', 'q_start', 'q_end', 's_start', 's_end', 'e_value', 'bit_score'])
-    sp_blast_df.e_value = pd.to_numeric(sp_blast_df.e_value, errors='coerce')
-    sp_blast_df = sp_blast_df[sp_blast_df['e_value'] < 0.01]
-    sp_blast_df['query_sp'] = query_id
-    sp_blast_df['subject_sp'] = subject_id
-    combined_df = combined_df.append(sp_blast_df)
-
-# Create dict of hit species for each CNE
-cne_sp_dict = defaultdict(set)
-for idx, row in combined_df.iterrows():
-    cne_id = row['query_id']
-    subject_id = row['subject_sp']
-    cne_sp_dict[cne_id].add(subject_id)
-    
+from cne_io import glob_files
+
+parser = argparse.ArgumentParser()
+parser.add_argument("merged_clusters")
+parser.add_argument("tree")
+parser.add_argument("blastn_dir")
+parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes (Blastn files, pastml shards)")
+parser.add_argument("--blast-cache", default="blast_cache", help="directory of parsed Blastn hits")
+parser.add_argument("--no-blast-cache", action="store_true", help="parse all Blastn files, do not use the cache")
+parser.add_argument("--no-html", action="store_true", help="write character states to a table, no HTML output")
+parser.add_argument("--states-file", default="pastml_states.tsv", help="character states table (--no-html)")
+parser.add_argument("--unique-patterns", action="store_true", help="run pastml once per unique presence/absence pattern")
+parser.add_argument("--shards", type=int, default=1, help="number of shards of clusters run in parallel by pastml")
+args = parser.parse_args()
+
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+# pastml is only imported when it runs, pandas by write_pastml_table
+from parsimony_table import read_blast_files, presence_absence_matrix
+from pastml_states import unique_patterns, run_pastml_shards, expand_states, write_states
+from stage_metrics import stage_metrics, startup_check
+startup_check()
+
+merged_clusters = args.merged_clusters
+tree = args.tree
+blastn_dir = args.blastn_dir
+# Blastn files can be compressed (.blastn.gz, .blastn.bgz)
+blastn_files = glob_files(blastn_dir + '*.blastn')
+
+# #### Blastn hits (e-value < 0.01) of all CNEs, with the species of the subject genome
+print("Reading", len(blastn_files), "Blastn files")
+blast_cache = None if args.no_blast_cache else args.blast_cache
+with stage_metrics("read_blast", input_file=blastn_dir) as metrics:
+    combined_df = read_blast_files(blastn_files, e_value_threshold=0.01, workers=args.workers, cache_dir=blast_cache)
+    metrics['rows'] = len(combined_df)
+    metrics['bytes'] = sum(os.path.getsize(blastn_file) for blastn_file in blastn_files)
+print(len(combined_df), "Blastn hits")
+
 
 # #### Species list
 species_list = ['dgig',
@@ -100,16 +110,6 @@ tax_dict = {
 }
 
 
-def retrieve_species_set(cluster_row):
-    species_set = set()
-    for cne in cluster_row:
-        #print(cne)
-        # Retrieve species ID and add to set
-        species = cne.split("_cne_")[0]
-        species_set.add(species)
-        species_set = set.union(species_set, cne_sp_dict[cne])
-    return(species_set)
-
 # ### Create pastml input table
 # 
 # Rows: species ID  
@@ -117,33 +117,51 @@ def retrieve_species_set(cluster_row):
 # 0: species not in cluster  
 # 1: species in cluster
 
-print("Creating pasml input table, this may take some time")
-pastml_data = pd.DataFrame(species_list, columns=['id'])
-with open(merged_clusters) as csvfile:
-    cne_file = csv.reader(csvfile, delimiter = ',')
-    cluster_counter = 0
-    for row in cne_file:
-        if cluster_counter % 100 == 0 :
-            print(cluster_counter, "clusters processed")
-        # species_set is the set of species in cluster
-        cluster_id = row[0]
-        cnes = row[1:]
-        species_set = retrieve_species_set(cnes)
-        pastml_data[cluster_id] = 0 # Fill all species with 0
-        pastml_data[cluster_id] = pastml_data[cluster_id].astype(int) # Avoid automatic convert to float
-        for species in species_set: # Add 1 to each species in cluster
-            pastml_data.loc[pastml_data['id'] == species, cluster_id] = 1
-        cluster_counter += 1
+def write_pastml_table(file_name, species_list, matrix, columns):
+    import pandas as pd
+    pd.concat([pd.DataFrame({'id': species_list}), pd.DataFrame(matrix, columns=columns)],
+              axis=1).to_csv(file_name, index=False)
+
+
+print("Creating pasml input table")
+with stage_metrics("pastml_table", input_file=merged_clusters) as metrics:
+    cluster_ids, presence_absence = presence_absence_matrix(merged_clusters, combined_df, species_list)
+    metrics['rows'] = len(cluster_ids)
 
 print("pastml table created. Writing to file: pastml_data.csv")
 
 # #### Write pastml data to file
 pastml_data_file = 'pastml_data.csv'
-pastml_data.to_csv(pastml_data_file, index=False)
+write_pastml_table(pastml_data_file, species_list, presence_absence, cluster_ids)
 print("Done")
 
+# #### Run pastml without HTML output, once per unique presence/absence pattern and/or in parallel shards
+if args.no_html or args.unique_patterns or args.shards > 1:
+    if args.unique_patterns:
+        patterns, pattern_of_cluster = unique_patterns(presence_absence)
+        print(len(cluster_ids), "clusters,", patterns.shape[1], "unique presence/absence patterns")
+        pastml_columns = ["pattern_" + str(i) for i in range(patterns.shape[1])]
+        pastml_columns_file = 'pastml_patterns.csv'
+        write_pastml_table(pastml_columns_file, species_list, patterns, pastml_columns)
+    else:
+        pastml_columns = cluster_ids
+        pastml_columns_file = pastml_data_file
+    if args.shards > 1:
+        print("Running pastml on", args.shards, "shards with", args.workers, "workers")
+    print("Running pastml, this may take some time.")
+    with stage_metrics("pastml", input_file=pastml_columns_file) as metrics:
+        states = run_pastml_shards(pastml_columns_file, pastml_columns, tree, "pastml_work", args.shards, args.workers)
+        metrics['rows'] = len(pastml_columns)
+    if args.unique_patterns:
+        states = expand_states(states, pattern_of_cluster, cluster_ids)
+    print("Writing character states to file:", args.states_file)
+    write_states(states, args.states_file)
+    print("pastml run complete.")
+    print("Then run parsimony_analysis_part2.py with:", args.states_file)
+    sys.exit()
+
 # Columns for which we want to reconstruct ancestral states
-columns = list(pastml_data.columns)[1:] # everything except id column
+columns = list(cluster_ids) # everything except id column
 
 # Path to the output compressed map visualisation
 html_compressed = "pastml_output_compressed.html"
@@ -152,8 +170,11 @@ html_compressed = "pastml_output_compressed.html"
 html = "pastml_output.html"
 
 print("Running pastml, this may take some time.")
-pastml_pipeline(data=pastml_data_file, data_sep=',', columns=columns, name_column=columns[0], tree=tree,
-                html_compressed=html_compressed, html=html, verbose=True)
+from pastml.acr import pastml_pipeline
+with stage_metrics("pastml", input_file=pastml_data_file) as metrics:
+    pastml_pipeline(data=pastml_data_file, data_sep=',', columns=columns, name_column=columns[0], tree=tree,
+                    html_compressed=html_compressed, html=html, verbose=True)
+    metrics['rows'] = len(columns)
 
 print("pastml run complete.")
 print("parse output html file using:")
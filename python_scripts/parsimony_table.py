@@ -0,0 +1,181 @@
+# # parsimony_table.py
+
+# ## Goal
+#
+# Build the pastml input table of parsimony_analysis_part1_with_blast.py:
+# 1. Read Blastn results (outfmt 6) of all species in parallel, keeping only hits below the e-value threshold.
+#    Filtered hits are cached as columnar tables (see cne_store.py) in cache_dir, one per Blastn file and threshold.
+#    Query IDs are cached as integer CNE IDs (see cne_ids.py), with the species table in the meta data.
+#    A Blastn file is parsed again only when its size or modification time changed.
+# 2. Build the species x cluster presence/absence matrix from the CNE clusters and the Blastn hits.
+# A species is present in a cluster if one of the CNEs of the cluster belongs to it
+# or has a Blastn hit in its genome.
+#
+# pandas is imported by the functions that use it, not when the module is imported (see benchmark_imports.py)
+#
+# ## Usage
+#
+# hits = read_blast_files(blastn_files, e_value_threshold=0.01, workers=8, cache_dir="blast_cache")
+# cluster_ids, matrix = presence_absence_matrix("pre_filtering_clusters.csv", hits, species_list)
+#
+# ***
+
+import csv
+import hashlib
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from os.path import abspath, join
+import numpy as np
+from cne_ids import cne_species, cne_id_to_code, format_cne_ids, species_table
+from cne_io import open_file
+from cne_store import write_table, read_table, is_table
+from stage_metrics import profiled
+
+batch_size = 1000000
+
+blast_column_names = ['query_id', 'subject_id', 'pct_identity', 'aln_length', 'n_of_mismatches',
+                      'gap_openings', 'q_start', 'q_end', 's_start', 's_end', 'e_value', 'bit_score']
+hit_columns = ['query_id', 'subject_sp', 'e_value', 'bit_score']
+
+
+# #### Function that returns the subject species of a Blastn file
+# Blastn files are named query_combined_cnes_vs_subject.blastn
+def blast_subject_species(blastn_file):
+    return blastn_file.split("/")[-1].split('_vs_')[1].split(".")[0]
+
+
+# #### Function that reads the hits of one Blastn file below the e-value threshold
+# The file is read in batches and filtered while reading
+# Returns DataFrame: query_id, subject_sp, e_value, bit_score
+def read_blast_file(blastn_file, e_value_threshold=0.01):
+    import pandas as pd
+    batches = []
+    # Blastn files can be compressed (see cne_io.py)
+    with open_file(blastn_file) as blastn:
+        reader = pd.read_csv(blastn, sep="\t", names=blast_column_names, usecols=['query_id', 'e_value', 'bit_score'],
+                             dtype={'query_id': str}, chunksize=batch_size)
+        with reader:
+            for hits in reader:
+                e_value = pd.to_numeric(hits['e_value'], errors='coerce').to_numpy(dtype=np.float64)
+                keep = e_value < e_value_threshold
+                batches.append(pd.DataFrame({'query_id': hits['query_id'].to_numpy(dtype=object)[keep],
+                                             'e_value': e_value[keep],
+                                             'bit_score': pd.to_numeric(hits['bit_score'], errors='coerce')
+                                             .to_numpy(dtype=np.float32)[keep]}))
+    if batches:
+        hits = pd.concat(batches, ignore_index=True)
+    else:
+        hits = pd.DataFrame({'query_id': pd.Series(dtype=object), 'e_value': pd.Series(dtype=np.float64),
+                             'bit_score': pd.Series(dtype=np.float32)})
+    hits.insert(1, 'subject_sp', blast_subject_species(blastn_file))
+    return hits[hit_columns]
+
+
+# #### Functions that convert query IDs to integer CNE IDs and back
+# Each distinct query ID is converted once. Returns codes and species table, None if a query ID is not a CNE ID
+def encode_query_ids(query_ids):
+    import pandas as pd
+    labels, names = pd.factorize(query_ids)
+    try:
+        species = species_table({cne_species(name) for name in names})
+        species_index = {sp: i for i, sp in enumerate(species)}
+        name_codes = np.array([cne_id_to_code(name, species_index) for name in names], dtype=np.int64)
+    except (ValueError, KeyError):
+        return None, None
+    return name_codes[labels], species
+
+
+def decode_query_ids(codes, species):
+    name_codes, labels = np.unique(codes, return_inverse=True)
+    return np.array(format_cne_ids(name_codes, species), dtype=object)[labels]
+
+
+# #### Function that reads the hits of one Blastn file from the cache, or parses and caches them
+# Cache entries are keyed by the path of the Blastn file and the e-value threshold,
+# and are valid while the size and modification time of the Blastn file are unchanged.
+# Hits are not cached if a query ID is not a CNE ID (species_cne_number)
+def read_blast_file_cached(blastn_file, e_value_threshold=0.01, cache_dir=None):
+    import pandas as pd
+    if cache_dir is None:
+        return read_blast_file(blastn_file, e_value_threshold)
+    stat = os.stat(blastn_file)
+    fingerprint = {'path': abspath(blastn_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                   'e_value_threshold': e_value_threshold}
+    key = hashlib.sha1((fingerprint['path'] + "\t" + repr(e_value_threshold)).encode()).hexdigest()
+    entry = join(cache_dir, key + ".hits")
+    if is_table(entry):
+        columns, meta = read_table(entry, mmap=False)
+        if all(meta.get(name) == value for name, value in fingerprint.items()) and 'query_code' in columns:
+            hits = pd.DataFrame({'query_id': decode_query_ids(columns['query_code'], meta['query_species']),
+                                 'e_value': columns['e_value'], 'bit_score': columns['bit_score']})
+            hits.insert(1, 'subject_sp', meta['subject_sp'])
+            return hits[hit_columns]
+    hits = read_blast_file(blastn_file, e_value_threshold)
+    query_codes, query_species = encode_query_ids(hits['query_id'])
+    # Stale entry, or entry of an older cache format (query IDs as strings)
+    if is_table(entry):
+        shutil.rmtree(entry)
+    if query_codes is not None:
+        write_table(entry, {'query_code': query_codes, 'e_value': hits['e_value'].to_numpy(),
+                            'bit_score': hits['bit_score'].to_numpy()},
+                    dict(fingerprint, kind='blast_hits', subject_sp=blast_subject_species(blastn_file),
+                         query_species=query_species))
+    return hits
+
+
+# #### Function that reads all Blastn files with a pool of worker processes
+# Hits are concatenated once, in the order of blastn_files. cache_dir=None disables the cache
+def read_blast_files(blastn_files, e_value_threshold=0.01, workers=1, cache_dir=None):
+    import pandas as pd
+    if workers > 1 and len(blastn_files) > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            all_hits = list(executor.map(read_blast_file_cached, blastn_files, [e_value_threshold] * len(blastn_files),
+                                         [cache_dir] * len(blastn_files)))
+    else:
+        all_hits = [read_blast_file_cached(blastn_file, e_value_threshold, cache_dir) for blastn_file in blastn_files]
+    if not all_hits:
+        return pd.DataFrame({column: pd.Series(dtype=object) for column in hit_columns})
+    hits = pd.concat(all_hits, ignore_index=True)
+    hits['subject_sp'] = hits['subject_sp'].astype('category')
+    return hits
+
+
+# #### Function that reads CNE clusters: one cluster per line, cluster_id followed by its CNE IDs
+# Returns list of cluster IDs and, for each CNE, its ID and the index of its cluster
+def read_clusters(merged_clusters):
+    cluster_ids = []
+    cne_ids = []
+    cne_clusters = []
+    with open_file(merged_clusters) as csvfile:
+        for row in csv.reader(csvfile, delimiter=','):
+            cne_clusters.extend([len(cluster_ids)] * (len(row) - 1))
+            cne_ids.extend(row[1:])
+            cluster_ids.append(row[0])
+    return cluster_ids, np.array(cne_ids, dtype=object), np.array(cne_clusters, dtype=np.int64)
+
+
+# #### Function that creates the presence/absence matrix
+# Rows: species of species_list, columns: clusters of merged_clusters
+# 1: species in cluster (one of its CNEs, or a Blastn hit of one of the cluster CNEs), 0: species not in cluster
+# Species that are not in species_list are ignored
+@profiled
+def presence_absence_matrix(merged_clusters, hits, species_list):
+    import pandas as pd
+    cluster_ids, cne_ids, cne_clusters = read_clusters(merged_clusters)
+    species_index = pd.Index(species_list)
+    matrix = np.zeros((len(species_list), len(cluster_ids)), dtype=np.int8)
+    # Species of the CNEs
+    cne_sp = np.array([cne_species(cne_id) for cne_id in cne_ids], dtype=object)
+    sp_idx = species_index.get_indexer(cne_sp)
+    found = sp_idx >= 0
+    matrix[sp_idx[found], cne_clusters[found]] = 1
+    # Species with a Blastn hit
+    hit_pairs = hits[['query_id', 'subject_sp']].drop_duplicates()
+    cne_positions = pd.DataFrame({'query_id': cne_ids, 'cluster': cne_clusters})
+    cluster_hits = cne_positions.merge(hit_pairs, on='query_id')
+    sp_idx = species_index.get_indexer(cluster_hits['subject_sp'].astype(object))
+    found = sp_idx >= 0
+    matrix[sp_idx[found], cluster_hits['cluster'].to_numpy()[found]] = 1
+    return cluster_ids, matrix
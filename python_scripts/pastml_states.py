@@ -0,0 +1,129 @@
+# # pastml_states.py
+
+# ## Goal
+#
+# Run pastml on unique presence/absence patterns instead of every CNE cluster.
+# With 13 species there are at most 2^13 patterns, in practice a few hundred: clusters with the same
+# pattern have the same reconstruction, so pastml runs once per pattern and states are copied back to the clusters.
+#
+# States table (pastml_states.tsv): one row per node of the tree, one column per cluster,
+# state '0', '1' or '0or1' (same states as the tooltips of pastml_output.html, parsed by parsimony_analysis_part2)
+# The table can also be written as a columnar table (see cne_store.py, e.g. pastml_states.states):
+# one int8 column per node with state codes 0, 1, 2 ('0or1'), meta: nodes and clusters
+#
+# Columns can be split in shards that are run by a pool of worker processes against the same tree,
+# the states of all shards are merged by column (cluster or pattern ID).
+#
+# Functions that read or write data frames import pandas when they are called (see benchmark_imports.py).
+#
+# ## Usage
+#
+# patterns, pattern_of_cluster = unique_patterns(presence_absence)
+# pattern_states = run_pastml_shards(patterns_file, pattern_columns, tree, work_dir, shards=64, workers=64)
+# states = expand_states(pattern_states, pattern_of_cluster, cluster_ids)
+# write_states(states, "pastml_states.tsv")
+# cluster_nodes = cluster_node_states(read_states("pastml_states.tsv"))  # parsimony_analysis_part2
+#
+# ***
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from os.path import join
+from cne_store import write_table, read_table, is_table
+
+state_codes = ['0', '1', '0or1']
+
+
+# #### Function that finds unique columns of the presence/absence matrix
+# Returns patterns (species x unique patterns) and the pattern index of each cluster
+def unique_patterns(presence_absence):
+    patterns, pattern_of_cluster = np.unique(presence_absence, axis=1, return_inverse=True)
+    return patterns, pattern_of_cluster.reshape(-1)
+
+
+# #### Function that reads the states of a pastml out_data file
+# pastml writes one line per node and state, e.g. a node with state '0 or 1' has two lines:
+# node  c0  c1          node  c0  c1
+# n1    0   1     ->    n1    0or1  1
+# n1    1
+def read_pastml_states(out_data):
+    import pandas as pd
+    table = pd.read_csv(out_data, sep="\t", dtype=str, keep_default_na=False)
+    table = table.set_index(table.columns[0])
+    nodes = table.index.unique()
+    states = {}
+    for column in table.columns:
+        node_states = table[column][table[column] != ""]
+        states[column] = node_states.groupby(level=0, sort=False).agg(lambda s: "or".join(sorted(s))).reindex(nodes)
+    states = pd.DataFrame(states, index=nodes)
+    states.index.name = 'node'
+    return states
+
+
+# #### Function that runs pastml on the given columns of a data table and returns their states
+# Intermediate pastml files are written to work_dir
+# pastml is imported here: it is slow to import and only needed to run it
+def run_pastml(data_file, columns, tree, work_dir, html_compressed=None, html=None, threads=0):
+    from pastml.acr import pastml_pipeline
+    out_data = join(work_dir, "pastml_states.tab")
+    pastml_pipeline(data=data_file, data_sep=',', columns=columns, name_column=columns[0], tree=tree,
+                    out_data=out_data, work_dir=work_dir, html_compressed=html_compressed, html=html, verbose=True,
+                    threads=threads)
+    return read_pastml_states(out_data)[columns]
+
+
+# #### Function that runs pastml on shards of columns with a pool of worker processes
+# Each shard has its own work directory (work_dir/shard_N), each worker runs pastml with one thread
+def run_pastml_shards(data_file, columns, tree, work_dir, shards=1, workers=1):
+    import pandas as pd
+    shards = max(1, min(shards, len(columns)))
+    if shards == 1:
+        return run_pastml(data_file, columns, tree, work_dir)
+    shard_columns = [list(shard) for shard in np.array_split(np.array(columns, dtype=object), shards)]
+    shard_dirs = [join(work_dir, "shard_" + str(i)) for i in range(shards)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = [executor.submit(run_pastml, data_file, shard, tree, shard_dir, threads=1)
+                   for shard, shard_dir in zip(shard_columns, shard_dirs)]
+        shard_states = [future.result() for future in futures]
+    states = pd.concat(shard_states, axis=1)
+    return states[columns]
+
+
+# #### Function that copies the states of each pattern to the clusters with this pattern
+def expand_states(pattern_states, pattern_of_cluster, cluster_ids):
+    import pandas as pd
+    states = pd.DataFrame(pattern_states.to_numpy()[:, pattern_of_cluster], index=pattern_states.index,
+                          columns=cluster_ids)
+    return states
+
+
+# #### Functions that write and read the states table, as TSV (.tsv) or columnar table (any other name)
+def write_states(states, states_file):
+    import pandas as pd
+    if states_file.endswith(".tsv"):
+        states.to_csv(states_file, sep="\t")
+        return
+    codes = pd.Index(state_codes)
+    columns = {"node_" + str(i): codes.get_indexer(states.iloc[i].to_numpy()).astype(np.int8)
+               for i in range(len(states))}
+    write_table(states_file, columns, {'kind': 'pastml_states', 'nodes': list(states.index),
+                                       'clusters': list(states.columns), 'states': state_codes})
+
+
+def read_states(states_file):
+    import pandas as pd
+    if not is_table(states_file):
+        return pd.read_csv(states_file, sep="\t", dtype=str, keep_default_na=False, index_col=0)
+    columns, meta = read_table(states_file)
+    codes = np.array(meta['states'], dtype=object)
+    states = pd.DataFrame(np.stack([codes[columns["node_" + str(i)]] for i in range(len(meta['nodes']))]),
+                          index=meta['nodes'], columns=meta['clusters'])
+    states.index.name = 'node'
+    return states
+
+
+# #### Function that converts the states table to the dictionary of parsimony_analysis_part2
+# {cluster_id: {node_name: state}}
+def cluster_node_states(states):
+    return {cluster: states[cluster].to_dict() for cluster in states.columns}
@@ -2,7 +2,7 @@
 
 # ## Usage
 #
-# retrieve_original_coordinates.py coord_dir padded_fasta_dir
+# retrieve_original_coordinates.py coord_dir padded_fasta_dir out_dir
 #
 # ## Goal
 #
@@ -17,81 +17,89 @@
 # padded_fasta_dir: directory containing padded single-scaffold FASTA files.
 # files must be named species_id_pad.fa
 #
+# Coordinate and FASTA files can be compressed (.gz, .bgz, see cne_io.py)
+#
 #
 # ## Output
 #
 # One coordinate file for each species, named 'species_prefix_orig_coords.tsv'
+# Columns: cne_id, single_sc_start, single_sc_end, scaffold, orig_start, orig_end, flag
+# flag is 'ok', or 'spans_scaffolds', 'in_padding', 'out_of_range' for CNEs that could not be placed on one scaffold
+# Compressed with CNE_COMPRESS=gz or bgz
 #
 #
 # ***
 
-import pandas as pd
-from Bio import SeqIO
-from collections import OrderedDict
-import glob
 import sys
+from os.path import getsize
+from cne_io import find_file, glob_files, open_file, output_name
 
 
 # #### User input
+if len(sys.argv) < 4 or sys.argv[1] in ("-h", "--help"):
+    sys.exit("Usage: retrieve_original_coordinates.py coord_dir padded_fasta_dir out_dir")
 coord_dir = sys.argv[1]
 padded_fasta_dir = sys.argv[2]
 out_dir = sys.argv[3]
 
-# #### Increase recursion limit
-sys.setrecursionlimit(10**9)
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+# pandas is imported by the functions that read and write coordinate tables
+import numpy as np
+from fasta_index import read_scaffold_lengths
+from stage_metrics import stage_metrics, startup_check
+startup_check()
 
+# #### Number of Ns added at the end of each scaffold (pad_scaffolds)
+pad_length = 100
 
 # #### List coordinate files
-coord_files = [f for f in glob.glob(coord_dir + "*.tsv")]
+coord_files = [f for f in glob_files(coord_dir + "*.tsv")]
 print("Found ", len(coord_files), " files in : ", coord_dir)
 
 
-# #### Scaffold finder function
-# Add length of next scaffolds until it finds the scaffold where the CNE is located
-def find_scaffold(start_coord, end_coord, cumul_coord, current_scaffold, scaffold_iter):
-    cumul_coord += scaffold_lengths[current_scaffold]
-    if end_coord < cumul_coord:
-        scaff_coord_end = scaffold_lengths[current_scaffold] - (cumul_coord - end_coord)
-        scaff_coord_start = scaffold_lengths[current_scaffold] - (cumul_coord - start_coord)
-        scaff_coords = [scaff_coord_start, scaff_coord_end]
-        return(current_scaffold, scaff_coords)
-    else:
-        # print("run next iteration")
-        current_scaffold = next(scaffold_iter)
-        return(find_scaffold(start_coord, end_coord, cumul_coord, current_scaffold, scaffold_iter))
-
-
 # #### Scaffold length dictionary generator
+# Lengths are read from the .fai index of the FASTA file, which is created on the first run
 def create_scaffold_length_dict(fasta_file):
-    scaffold_lengths = OrderedDict([])
     print("Retrieving coordinates from original (padded) fasta file: ", fasta_file)
-    for seq_record in SeqIO.parse(fasta_file, "fasta"):
-        scaffold_id = seq_record.id
-        scaffold_length = len(seq_record)
-        scaffold_lengths[scaffold_id] = scaffold_length
-    return(scaffold_lengths)
+    return(read_scaffold_lengths(fasta_file))
+
+
+# #### Function that reads a coordinate file: cne_id, start, end
+def read_coords(coord_file_name):
+    import pandas as pd
+    with open_file(coord_file_name) as coord_file:
+        return(pd.read_csv(coord_file, sep= "\t", names = ['cne_id', 'start', 'end']))
 
 
 # #### Main function
+# Coordinates are on the concatenated padded scaffolds: cumulative scaffold lengths are computed once
+# and the scaffold of each CNE is the first one whose cumulative end is greater than the CNE end.
+# flag: 'spans_scaffolds' when the CNE starts on a previous scaffold, 'in_padding' when it reaches
+# the N padding at the end of the scaffold, 'out_of_range' when it ends after the last scaffold
 def retrieve_original_coordinates(coord_df, scaffold_length_dict):
-    # Create output data frame
-    orig_coordinates = pd.DataFrame(columns= ['single_sc_start', 'single_sc_end', 'scaffold', 'orig_start', 'orig_end'])
-    for index, row in coord_df.iterrows():
-        scaffold_iter = iter(scaffold_length_dict)
-        cumul_coord = 0
-        current_scaffold = next(scaffold_iter)
-        start = row['start']
-        end = row['end']
-        cne_id = row['cne_id']
-        #print(cne_id)
-        #print("run find_scaffold")
-        scaffold = find_scaffold(start, end, cumul_coord, current_scaffold, scaffold_iter)
-        scaffold_id = scaffold[0]
-        orig_start = scaffold[1][0]
-        orig_end = scaffold[1][1]
-        orig_coordinates.loc[cne_id] = [start, end, scaffold_id, orig_start, orig_end]
-    orig_coordinates.index.name = 'cne_id'
-    orig_coordinates.reset_index(inplace=True)
+    import pandas as pd
+    scaffold_ids = np.array(list(scaffold_length_dict.keys()), dtype=object)
+    scaffold_lengths = np.fromiter(scaffold_length_dict.values(), dtype=np.int64, count=len(scaffold_length_dict))
+    cumul_end = np.cumsum(scaffold_lengths)
+    cumul_start = cumul_end - scaffold_lengths
+    start = coord_df['start'].to_numpy(dtype=np.int64)
+    end = coord_df['end'].to_numpy(dtype=np.int64)
+    scaffold_idx = np.searchsorted(cumul_end, end, side='right')
+    out_of_range = scaffold_idx >= len(scaffold_lengths)
+    scaffold_idx[out_of_range] = 0
+    orig_start = start - cumul_start[scaffold_idx]
+    orig_end = end - cumul_start[scaffold_idx]
+    flag = np.full(len(start), 'ok', dtype=object)
+    flag[orig_end >= scaffold_lengths[scaffold_idx] - pad_length] = 'in_padding'
+    flag[orig_start < 0] = 'spans_scaffolds'
+    flag[out_of_range] = 'out_of_range'
+    scaffold = scaffold_ids[scaffold_idx]
+    scaffold[out_of_range] = ''
+    orig_start[out_of_range] = -1
+    orig_end[out_of_range] = -1
+    orig_coordinates = pd.DataFrame({'cne_id': coord_df['cne_id'].to_numpy(), 'single_sc_start': start,
+                                     'single_sc_end': end, 'scaffold': scaffold, 'orig_start': orig_start,
+                                     'orig_end': orig_end, 'flag': flag})
     return(orig_coordinates)
 
 
@@ -102,15 +110,23 @@ for file in coord_files:
     # Retrieve species name
     species_prefix = file.split("/")[-1].split("_")[0]
     # Retrieve expected fasta file name
-    fasta_file = padded_fasta_dir + species_prefix + "_pad.fa"
+    fasta_file = find_file(padded_fasta_dir + species_prefix + "_pad.fa")
     # Create output file name
-    output_file_name = out_dir + species_prefix + "_orig_coords.tsv"
+    output_file_name = output_name(out_dir + species_prefix + "_orig_coords.tsv")
     # Read coordinate_file
-    coord_df = pd.read_csv(file, sep= "\t", names = ['cne_id', 'start', 'end'])
-    #coord_df = coord_df.loc[1:]
-    # Create ordered dict to hold the scaffold lengths
-    scaffold_lengths = create_scaffold_length_dict(fasta_file)
-    orig_coordinates = retrieve_original_coordinates(coord_df, scaffold_lengths)
+    with stage_metrics("original_coordinates", input_file=file) as metrics:
+        coord_df = read_coords(file)
+        #coord_df = coord_df.loc[1:]
+        # Create ordered dict to hold the scaffold lengths
+        scaffold_lengths = create_scaffold_length_dict(fasta_file)
+        orig_coordinates = retrieve_original_coordinates(coord_df, scaffold_lengths)
+        metrics['rows'] = len(coord_df)
+        metrics['bytes'] = getsize(file)
+    flag_counts = orig_coordinates['flag'].value_counts()
+    for flag in ['spans_scaffolds', 'in_padding', 'out_of_range']:
+        if flag in flag_counts:
+            print("Warning:", flag_counts[flag], "CNEs flagged", flag)
     print("Writing original coordinates file to: ", output_file_name)
-    orig_coordinates.to_csv(output_file_name, sep="\t", index=False)
+    with open_file(output_file_name, 'wt') as output_file:
+        orig_coordinates.to_csv(output_file, sep="\t", index=False)
 
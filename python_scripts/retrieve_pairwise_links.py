@@ -1,17 +1,24 @@
 
-import json
-import pandas as pd
-import  csv
 import sys
-from collections import defaultdict
-import glob
+from os.path import getsize
+from cne_io import glob_files
 
 
 # #### User input
 
+if len(sys.argv) < 3 or sys.argv[1] in ("-h", "--help"):
+    sys.exit("Usage: retrieve_pairwise_links.py cne_dict cnefinder_output_dir")
 cne_dict = sys.argv[1]
 cf_output_dir = sys.argv[2]
 
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+import numpy as np
+from cne_index import cne_index_from_table, find_first_cne
+from cne_store import read_cne_table, write_links
+from cf_reader import cf_species, read_cf_batches
+from stage_metrics import stage_metrics, startup_check
+startup_check()
+
 
 # #### Test input paths
 #cne_dict = '../../results_for_paper/cnidaria_final/filtering/filtered_cne_dict.txt'
@@ -19,61 +26,50 @@ cf_output_dir = sys.argv[2]
 
 
 # #### List CNEFinder output files
-cf_output_files = glob.glob(cf_output_dir + '*.out')
+cf_output_files = glob_files(cf_output_dir + '*.out')
 
 # #### Open dictionary of non_overlapping cnes created with generate_cne_ids.py
 
+# json dictionary or columnar table (see cne_store.py)
 print("reading dictionary of CNEs")
-with open(cne_dict) as json_file:
-    all_species_cne_dict = json.load(json_file)
+with stage_metrics("read_cne_dict", input_file=cne_dict):
+    cne_table, cne_species = read_cne_table(cne_dict)
+
+
+# #### Build interval index of CNEs
+# Sorted start/end arrays for each species, searched with binary search
+
+print("building CNE index")
+with stage_metrics("build_cne_index", input_file=cne_dict) as metrics:
+    cne_index = cne_index_from_table(cne_table, cne_species)
+    metrics['rows'] = len(cne_table['cne'])
 
 
 # #### Function that retrieves CNE_ids from each 2-species CNE
-# Returns list of list:  
+# Returns array of integer CNE IDs (see cne_ids.py), one row per pair:  
 # [[sp1_cne_X, sp2_cne_X], [sp1_cne_X, sp2_cne_X] ... ]
 
 def retrieve_pairwise_links(cne_file):
     print("cne_file is:", cne_file)
-    output_list = []
-    # Identiy reference and query species
-    #ref_species = cne_file.split("/")[-1].split("_vs_")[0]
-    #query_species = cne_file.split("/")[-1].split("_vs_")[1].split(".")[0]
-    # Read CNEFinder file 
-    #column_names = ['ref_chrom', 'ref_start', 'ref_end',
-    #                  'query_chrom', 'query_start', 'query_end',
-    #                  'ref_length', 'query_length', 'sim']
-    
-    cnes = pd.read_csv(cne_file, sep = "\t")#, names = column_names)
-    ref_species = cnes.columns[0].split("_")[0]
-    query_species = cnes.columns[3].split("_")[0]    
-
-    # Iterate over each row (=CNE) in CNEFidner output file
-    for index, row in cnes.iterrows():
-        # Create list that will contain the two CNE IDs in pair
-        pairwise_list = []
-        #ref_start = row['ref_start']
-        #ref_end = row['ref_end']
-        #query_start = row['query_start']
-        #query_end = row['query_end']
-        ref_start = row[1]
-        ref_end = row[2]
-        query_start = row[4]
-        query_end = row[5]        
+    # Identify reference and query species
+    ref_species, query_species = cf_species(cne_file)
+    # Read CNEFinder file in batches of rows (see cf_reader.py)
+    all_pairs = []
+    for cnes in read_cf_batches(cne_file, columns=['ref_start', 'ref_end', 'query_start', 'query_end']):
         # Retrieve corresponding CNE_ids by searching overlapping coordinates in unique_non_overlap_cnes.txt
         # unique_non_overlap_cnes.txt was loaded as dictionary (all_species_cne_dict)
-        for cne_id , cne_id_coords in all_species_cne_dict[ref_species].items():
-            if (cne_id_coords[0] <= ref_end <= cne_id_coords[1]) or  (ref_start <= cne_id_coords[1] <= ref_end):
-                pairwise_list.append(cne_id)
-                break
-        for cne_id , cne_id_coords in all_species_cne_dict[query_species].items():
-            if (cne_id_coords[0] <= query_end <= cne_id_coords[1]) or  (query_start <= cne_id_coords[1] <= query_end):
-                pairwise_list.append(cne_id)
-                break
-        # Add list to final list of lists. 
+        # First overlapping CNE in dictionary order, -1 if the CNE was filtered out
+        ref_codes = find_first_cne(cne_index, ref_species, cnes['ref_start'], cnes['ref_end'], key='code')
+        query_codes = find_first_cne(cne_index, query_species, cnes['query_start'], cnes['query_end'], key='code')
         # If a CNE in pair was filtered out (absent from unique_non_overlap_cnes), discard pair
-        if len(pairwise_list) == 2 and pairwise_list not in output_list:
-            output_list.append(pairwise_list)
-    return(output_list)
+        pairs = np.column_stack((ref_codes, query_codes))
+        all_pairs.append(pairs[(ref_codes >= 0) & (query_codes >= 0)])
+    pairs = np.concatenate(all_pairs) if all_pairs else np.empty((0, 2), dtype=np.int64)
+    # Keep first occurrence of each pair
+    if len(pairs) == 0:
+        return pairs
+    _, first_index = np.unique(pairs, axis=0, return_index=True)
+    return pairs[np.sort(first_index)]
 
 
 # #### Create list of links and add all pairwise links
@@ -81,12 +77,14 @@ def retrieve_pairwise_links(cne_file):
 print("Identifying all pairwise links")
 all_pairwise_links = []
 for cf_file in cf_output_files:
-    pairwise_links = retrieve_pairwise_links(cf_file)
-    all_pairwise_links = all_pairwise_links + pairwise_links
+    with stage_metrics("pairwise_links", input_file=cf_file) as metrics:
+        pairwise_links = retrieve_pairwise_links(cf_file)
+        metrics['rows'] = len(pairwise_links)
+        metrics['bytes'] = getsize(cf_file)
+    all_pairwise_links.append(pairwise_links)
 print("Done")
 
 
-with open('pairwise_links.json', 'w') as f:
-    json.dump(all_pairwise_links, f)
-
-
+# #### Write integer links to file
+# CNE IDs are converted back to strings by merge_all_links.py
+write_links('pairwise_links.links', np.concatenate(all_pairwise_links) if all_pairwise_links else [], cne_species)
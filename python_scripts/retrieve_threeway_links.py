@@ -3,14 +3,25 @@
 # 
 # Retrieve CNE_ids for each set of coordinates in overlap file
 # 
+# #### Usage
+# 
+# retrieve_threeway_links.py overlap_file [overlap_file ...] cne_dict [--workers N] [--combined output.links]
+# 
+# Several overlap files (or directories of overlap files, or @file_list with one overlap file per line) are
+# processed with the same index of CNEs, built once. With --workers, files are processed by worker processes
+# that share the index (fork).
+# 
 # #### Input
 # 
-# - overlap file (split) generated by calculate_overlaps_split.py
-# - Filtered dictionary of CNEs (filtered_cne_dict.txt)
+# - overlap file (split) generated by calculate_overlaps_split.py or merge_overlaps.py (json, JSON Lines or columnar)
+# - Filtered dictionary of CNEs (filtered_cne_dict.txt or filtered_cne_dict.cnes)
 # 
 # #### Output
 # 
-# List of 3-way links in json format: three_way_links.json
+# List of 3-way links with integer CNE IDs (see cne_store.py): threeway_links/overlap_file.links
+# With --combined, links of all overlap files are written to one file, in the order of the overlap files,
+# and no file is written in threeway_links.
+# Without --combined, overlap files must have different file names (output files are named after them).
 # [
 # [sp1_cneA, sp2_cneB, sp3_cneC],
 # ..
@@ -18,62 +29,139 @@
 # [sp1_cneX, sp2_cneY, sp3_cneZ]
 # ]
 # 
-# This list needs to be merged with pairwise_links.json from retrieve_pairwise_links.py
+# This list needs to be merged with pairwise_links.links from retrieve_pairwise_links.py
  
 
-import json
-from pathlib import Path
+import argparse
+import glob
 import sys
+from cne_io import glob_files
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from os.path import isdir, join
+from pathlib import Path
+from collections import Counter, defaultdict
+
+parser = argparse.ArgumentParser(fromfile_prefix_chars="@")
+parser.add_argument("overlap_files", nargs="+",
+                    help="overlap files or directories of overlap files (@file_list: one overlap file per line)")
+parser.add_argument("cne_dict")
+parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+parser.add_argument("--combined", help="write the links of all overlap files to this file")
+args = parser.parse_args()
+
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+import numpy as np
+from cne_index import cne_index_from_table, find_overlapping_cnes
+from cne_store import read_overlap_table, read_cne_table, write_links, links_to_arrays, is_table, LinksWriter
+from stage_metrics import stage_metrics, startup_check
+startup_check()
 
-overlap_file = sys.argv[1]
 #overlap_file = '../../results_for_paper/cnidaria_final/calculate_overlaps_update/overlap_files/ofav_vs_spis.out_8_overlap_spis_ofav_vs_pdam.out_2.txt'
 
-cne_dict = sys.argv[2]
+cne_dict = args.cne_dict
 #cne_dict = '../../results_for_paper/cnidaria_final/filtering/filtered_cne_dict.txt'
 
+# #### List overlap files
+# Directories (other than columnar tables) are replaced by the overlap files they contain
+overlap_files = []
+for path in args.overlap_files:
+    if isdir(path) and not is_table(path):
+        overlap_files.extend(sorted(glob_files(join(path, "*.txt")) + glob_files(join(path, "*.jsonl"))
+                                    + glob.glob(join(path, "*.overlaps"))))
+    else:
+        overlap_files.append(path)
+print("Number of overlap files:", len(overlap_files))
+
+
+# #### Function that returns the file name of an overlap file (or table directory)
+def file_name(overlap_file):
+    return overlap_file.rstrip("/").split("/")[-1]
+
+
 #### Create output directory
+# Overlap files with the same file name (e.g. from different directories) would overwrite each other's links
 out_dir = "threeway_links"
-Path(out_dir).mkdir(parents=True, exist_ok=True)
+if not args.combined:
+    duplicates = [name for name, count in Counter(map(file_name, overlap_files)).items() if count > 1]
+    if duplicates:
+        sys.exit("Overlap files with the same file name, use --combined or rename them: " + ", ".join(duplicates))
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
 
 
-# #### Read overlap file
-with open(overlap_file) as json_file:
-        overlaps = json.load(json_file)
+# #### Read CNE dictionary and build interval index of CNEs
+# Sorted start/end arrays for each species, searched with binary search
+print("reading dictionary of CNEs")
+with stage_metrics("build_cne_index", input_file=cne_dict) as metrics:
+    cne_table, cne_species = read_cne_table(cne_dict)
+    cne_index = cne_index_from_table(cne_table, cne_species)
+    metrics['rows'] = len(cne_table['cne'])
 
 
-# #### Read CNE dictionary
-print("reading dictionary of CNEs")
-with open(cne_dict) as json_file:
-    all_species_cne_dict = json.load(json_file)
-
-
-# #### Function that retrieves CNE_ids from each 2-species CNE
-# Returns list of list:  
-# [[sp1_cne_X, sp2_cne_X], [sp1_cne_X, sp2_cne_X] ... ]
-def retrieve_threeway_links_IDs(multi_species_coords):  
-    # Create a new output list
-    output_list = []
-    # retrieve coordinates of CNE for each species
-    for species, coords in multi_species_coords.items():
-        #print(species)
-        start = int(coords.split(":")[0])
-        end = int(coords.split(":")[1])
-        # retrieve the cne_id that corresponds to the coords from dict of all cne_ids and append to output list
-        for cne_id , cne_id_coords in all_species_cne_dict[species].items():
-            if (cne_id_coords[0] <= end <= cne_id_coords[1]) or  (start <= cne_id_coords[1] <= end):
-                #print("found cne ID")
-                output_list.append(cne_id)
-    return output_list
-
-threeway_links = []
-for cne_id, multi_species_coords in overlaps.items():
-    cne_id_list = retrieve_threeway_links_IDs(multi_species_coords)
-    if cne_id_list:
-        threeway_links.append(retrieve_threeway_links_IDs(multi_species_coords))
-
-#### Write to file
-output_path = out_dir + "/" + overlap_file.split("/")[-1] + ".json"
-with open(output_path, 'w') as f:
-    json.dump(threeway_links, f)
+# #### Function that retrieves CNE_ids from each multi-species CNE
+# Returns list of list of integer CNE IDs:  
+# [[sp1_cne_X, sp2_cne_X, sp3_cne_X], [sp1_cne_X, sp2_cne_X, sp3_cne_X] ... ]
+# All CNEs in the overlap file are searched at once, one batch per species
+def retrieve_threeway_links_IDs(species, starts, ends):
+    # retrieve the cne_ids that correspond to the coords from dict of all cne_ids
+    found_entries = []
+    found_positions = []
+    found_ids = []
+    for species_idx, sp in enumerate(species):
+        query_idx, cne_codes = find_overlapping_cnes(cne_index, sp, starts[:, species_idx], ends[:, species_idx],
+                                                     key='code')
+        found_entries.append(query_idx)
+        found_positions.append(np.full(len(query_idx), species_idx))
+        found_ids.append(cne_codes)
+    if not found_ids:
+        return []
+    found_entries = np.concatenate(found_entries)
+    found_positions = np.concatenate(found_positions)
+    found_ids = np.concatenate(found_ids)
+    # Matches of each species are in dictionary order, sort by entry then species (stable)
+    order = np.lexsort((found_positions, found_entries))
+    # Create one output list per entry, entries without any CNE_id are discarded
+    output_lists = defaultdict(list)
+    for entry_idx, cne_id in zip(found_entries[order].tolist(), found_ids[order].tolist()):
+        output_lists[entry_idx].append(cne_id)
+    return [output_lists[entry_idx] for entry_idx in sorted(output_lists)]
+
+
+# #### Function that retrieves the links of one overlap file
+# Links are written to threeway_links/overlap_file.links, or returned as arrays (see cne_store.py) with --combined
+def process_overlap_file(overlap_file):
+    # json dictionary, JSON Lines or columnar table (see cne_store.py)
+    with stage_metrics("read_overlaps", input_file=overlap_file) as metrics:
+        overlap_species, overlap_numbers, overlap_starts, overlap_ends = read_overlap_table(overlap_file)
+        metrics['rows'] = len(overlap_numbers)
+
+    with stage_metrics("threeway_links", input_file=overlap_file) as metrics:
+        threeway_links = retrieve_threeway_links_IDs(overlap_species, overlap_starts, overlap_ends)
+        metrics['rows'] = len(threeway_links)
+
+    if args.combined:
+        return links_to_arrays(threeway_links)
+    #### Write to file
+    write_links(out_dir + "/" + file_name(overlap_file) + ".links", threeway_links, cne_species)
+    return len(threeway_links)
+
+
+# #### Process all overlap files
+# Results are in the order of the overlap files
+def write_results(results):
+    links_writer = LinksWriter(args.combined, cne_species) if args.combined else None
+    for counter, result in enumerate(results):
+        if links_writer is not None:
+            links_writer.append(*result)
+        if counter % 100 == 0:
+            print(counter, "overlap files processed")
+    if links_writer is not None:
+        links_writer.close()
+        print("Links written to:", args.combined, "number of links:", links_writer.links)
 
 
+if args.workers > 1 and len(overlap_files) > 1:
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        write_results(executor.map(process_overlap_file, overlap_files))
+else:
+    write_results(map(process_overlap_file, overlap_files))
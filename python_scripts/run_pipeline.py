@@ -0,0 +1,265 @@
+# # run_pipeline.py
+
+# ## Usage
+#
+# run_pipeline.py cnefinder_output_dir tree blastn_dir [--cne-dict filtered_cne_dict.txt] [--work-dir dir]
+#                 [--force] [--dry-run]
+#
+# ## Goal
+#
+# Run all stages of the pipeline, skipping the ones whose inputs did not change since the last run:
+# generate_cne_ids -> calculate_overlaps_split -> retrieve_threeway_links / retrieve_pairwise_links
+# -> merge_all_links -> assign_cluster_ids -> parsimony_analysis_part1_with_blast
+#
+# Each stage is split in tasks (e.g. one overlap task per pair of CNEFinder files with a species in common).
+# A task is skipped when the content hashes of its inputs, its script and its arguments are the same as in
+# the last run and all its outputs exist. When one CNEFinder file changes, only the tasks that read it are run again.
+#
+# ## Input
+#
+# cnefinder_output_dir: directory containing all CNEfinder output files
+# tree: phylogenetic tree in Newick format
+# blastn_dir: directory of Blastn results
+# --cne-dict: dictionary of CNEs used to retrieve links, e.g. filtered_cne_dict.txt created by filter_CNEs.
+#             Default: unique_non_overlap_cnes.cnes created by generate_cne_ids.py
+#
+# ## Output
+#
+# Outputs of all scripts, in work_dir.
+# Hashes of the last run are kept in work_dir/pipeline_cache.json
+#
+# ***
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+from itertools import combinations
+from os.path import basename, dirname, abspath, exists, isdir, join
+from cf_reader import cf_species
+from cne_io import glob_files, output_name, strip_compression
+from stage_metrics import startup_check
+
+script_dir = dirname(abspath(__file__))
+
+
+# #### Content hash of files and directories (columnar tables)
+# Hashes are kept with the size and modification time of each file, unchanged files are not read again
+def file_hash(path, fingerprints):
+    stat = os.stat(path)
+    fingerprint = [stat.st_size, stat.st_mtime_ns]
+    known = fingerprints.get(path)
+    if known and known[0] == fingerprint:
+        return known[1]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    fingerprints[path] = [fingerprint, sha.hexdigest()]
+    return sha.hexdigest()
+
+
+def path_hash(path, fingerprints):
+    if not exists(path):
+        return "missing"
+    if isdir(path):
+        sha = hashlib.sha256()
+        for file_name in sorted(os.listdir(path)):
+            sha.update(file_name.encode())
+            sha.update(path_hash(join(path, file_name), fingerprints).encode())
+        return sha.hexdigest()
+    return file_hash(path, fingerprints)
+
+
+# #### Task: one run of a script
+# inputs: files read by the script, outputs: files written by the script (relative to work_dir)
+def task(name, script, arguments, inputs, outputs):
+    return {'name': name, 'script': script, 'arguments': arguments, 'inputs': inputs, 'outputs': outputs}
+
+
+# #### Function that returns the modules of script_dir imported by a script, directly or by its modules
+# Imports inside functions are included (e.g. modules imported once the arguments are parsed)
+def local_modules(script, modules=None):
+    modules = set() if modules is None else modules
+    with open(join(script_dir, script)) as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module = name.split(".")[0] + ".py"
+            if module not in modules and exists(join(script_dir, module)):
+                modules.add(module)
+                local_modules(module, modules)
+    return modules
+
+
+# Task hashes include the script and its local modules (e.g. cne_store.py): a change of a module runs its tasks again
+script_modules = {}
+
+
+def task_hash(pipeline_task, fingerprints):
+    if pipeline_task['script'] not in script_modules:
+        script_modules[pipeline_task['script']] = sorted(local_modules(pipeline_task['script']))
+    sha = hashlib.sha256()
+    for script in [pipeline_task['script']] + script_modules[pipeline_task['script']]:
+        sha.update(script.encode())
+        sha.update(file_hash(join(script_dir, script), fingerprints).encode())
+    sha.update(json.dumps(pipeline_task['arguments']).encode())
+    for input_path in pipeline_task['inputs']:
+        sha.update(input_path.encode())
+        sha.update(path_hash(input_path, fingerprints).encode())
+    return sha.hexdigest()
+
+
+def remove_path(path):
+    if isdir(path):
+        shutil.rmtree(path)
+    elif exists(path):
+        os.remove(path)
+
+
+# #### Function that runs a task unless its outputs are up to date
+def run_task(pipeline_task, cache, fingerprints, force=False, dry_run=False):
+    inputs_hash = task_hash(pipeline_task, fingerprints)
+    cached = cache['tasks'].get(pipeline_task['name'])
+    if not force and cached and cached['hash'] == inputs_hash and all(exists(path) for path in pipeline_task['outputs']):
+        return False
+    print("Running:", pipeline_task['name'])
+    if dry_run:
+        return True
+    command = [sys.executable, join(script_dir, pipeline_task['script'])] + pipeline_task['arguments']
+    if subprocess.run(command).returncode != 0:
+        save_cache(cache, cache_file)
+        sys.exit("Task failed: " + pipeline_task['name'])
+    cache['tasks'][pipeline_task['name']] = {'hash': inputs_hash, 'outputs': pipeline_task['outputs']}
+    return True
+
+
+# #### Function that runs all tasks of a stage
+# Outputs of tasks of this stage that are no longer part of the pipeline (e.g. a removed CNEFinder file) are deleted
+def run_stage(stage, tasks, cache, fingerprints, force=False, dry_run=False):
+    task_names = {pipeline_task['name'] for pipeline_task in tasks}
+    for name, cached in list(cache['tasks'].items()):
+        if name.startswith(stage + ":") and name not in task_names:
+            print("Removing outputs of:", name)
+            if not dry_run:
+                for path in cached['outputs']:
+                    remove_path(path)
+                del cache['tasks'][name]
+    number_run = 0
+    for pipeline_task in tasks:
+        if run_task(pipeline_task, cache, fingerprints, force, dry_run):
+            number_run += 1
+    print(stage, ":", number_run, "of", len(tasks), "tasks run")
+    return number_run
+
+
+def save_cache(cache, cache_file):
+    # Forget files that no longer exist
+    for path in [path for path in cache['fingerprints'] if not exists(path)]:
+        del cache['fingerprints'][path]
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("cf_output_dir")
+parser.add_argument("tree")
+parser.add_argument("blastn_dir")
+parser.add_argument("--cne-dict", help="dictionary of CNEs used to retrieve links (default: all CNEs)")
+parser.add_argument("--work-dir", default=".")
+parser.add_argument("--force", action="store_true", help="run all tasks")
+parser.add_argument("--dry-run", action="store_true", help="only print the tasks that would run")
+args = parser.parse_args()
+# No modules to import for the stage: tasks run the scripts (see benchmark_imports.py)
+startup_check()
+
+cf_output_dir = abspath(args.cf_output_dir) + "/"
+tree = abspath(args.tree)
+blastn_dir = abspath(args.blastn_dir) + "/"
+cne_dict = abspath(args.cne_dict) if args.cne_dict else "unique_non_overlap_cnes.cnes"
+
+os.makedirs(args.work_dir, exist_ok=True)
+os.chdir(args.work_dir)
+cache_file = "pipeline_cache.json"
+if exists(cache_file):
+    with open(cache_file) as f:
+        cache = json.load(f)
+else:
+    cache = {'tasks': {}, 'fingerprints': {}}
+fingerprints = cache['fingerprints']
+
+cf_files = sorted(glob_files(cf_output_dir + "*.out"))
+cf_comps = {cf_file: cf_species(cf_file) for cf_file in cf_files}
+print("Found", len(cf_files), "CNEFinder files in:", cf_output_dir)
+
+
+# #### Stage 1: CNE IDs
+species = sorted({sp for comp in cf_comps.values() for sp in comp})
+tasks = [task("generate_cne_ids:all", "generate_cne_ids.py", [cf_output_dir], cf_files,
+              ["unique_non_overlap_cnes.txt", "unique_non_overlap_cnes.cnes"]
+              + [output_name(sp + "_cne_coords.tsv") for sp in species])]
+run_stage("generate_cne_ids", tasks, cache, fingerprints, args.force, args.dry_run)
+save_cache(cache, cache_file)
+
+
+# #### Stage 2: overlaps, one task per pair of CNEFinder files with one species in common
+os.makedirs("overlap_files", exist_ok=True)
+tasks = []
+for file1, file2 in combinations(cf_files, 2):
+    if len(set(cf_comps[file1]) & set(cf_comps[file2])) != 1:
+        continue
+    specific_comp1 = [sp for sp in cf_comps[file1] if sp not in cf_comps[file2]][0]
+    overlap_file = ("overlap_files/" + strip_compression(basename(file1)) + "_overlap_" + specific_comp1 + "_"
+                    + strip_compression(basename(file2)) + ".overlaps")
+    tasks.append(task("overlaps:" + overlap_file, "calculate_overlaps_split.py", [file1, file2, "overlap_files/"],
+                      [file1, file2], [overlap_file]))
+overlap_files = [pipeline_task['outputs'][0] for pipeline_task in tasks]
+run_stage("overlaps", tasks, cache, fingerprints, args.force, args.dry_run)
+save_cache(cache, cache_file)
+
+
+# #### Stage 3: links
+# Task names start with the stage name: links of removed CNEFinder or overlap files are deleted by run_stage
+tasks = [task("links:pairwise", "retrieve_pairwise_links.py", [cne_dict, cf_output_dir], [cne_dict] + cf_files,
+              ["pairwise_links.links"])]
+for overlap_file in overlap_files:
+    links_file = "threeway_links/" + basename(overlap_file) + ".links"
+    tasks.append(task("links:threeway:" + links_file, "retrieve_threeway_links.py", [overlap_file, cne_dict],
+                      [overlap_file, cne_dict], [links_file]))
+links_files = [pipeline_task['outputs'][0] for pipeline_task in tasks]
+run_stage("links", tasks, cache, fingerprints, args.force, args.dry_run)
+save_cache(cache, cache_file)
+
+
+# #### Stage 4: CNE clusters
+tasks = [task("clusters:all", "merge_all_links.py", [], links_files, ["merged_cne_clusters.csv"])]
+run_stage("clusters", tasks, cache, fingerprints, args.force, args.dry_run)
+save_cache(cache, cache_file)
+
+
+# #### Stage 5: cluster IDs, clusters of one species are discarded
+tasks = [task("cluster_ids:all", "assign_cluster_ids.py", ["merged_cne_clusters.csv", "pre_filtering_clusters.csv"],
+              ["merged_cne_clusters.csv"], ["pre_filtering_clusters.csv"])]
+run_stage("cluster_ids", tasks, cache, fingerprints, args.force, args.dry_run)
+save_cache(cache, cache_file)
+
+
+# #### Stage 6: ancestral state reconstruction
+blastn_files = sorted(glob_files(blastn_dir + "*.blastn"))
+tasks = [task("parsimony:all", "parsimony_analysis_part1_with_blast.py",
+              ["pre_filtering_clusters.csv", tree, blastn_dir],
+              ["pre_filtering_clusters.csv", tree] + blastn_files, ["pastml_data.csv"])]
+run_stage("parsimony", tasks, cache, fingerprints, args.force, args.dry_run)
+save_cache(cache, cache_file)
+
+print("Pipeline done.")
@@ -1,47 +1,54 @@
 
-import sys
+# Usage: split_overlap_swarm.py cnefinder_output_file_1 cnefinder_output_file_2 [--local] [--workers N] [--output file]
+
+# Goal: split two CNEFinder files that share a species into shards and compare shard pairs.
+# By default a swarm file with one calculate_overlaps_split.py job per shard pair is written.
+# With --local, shard pairs are compared on this machine by a pool of worker processes
+# and the results are merged into one overlap file (merge_overlaps.py is not needed): --output, by default
+# common_overlap_specific1_specific2.overlaps in the current directory. It is not written to overlap_files/,
+# where merge_overlaps.py would read it with the shard outputs of the swarm jobs.
+
+import argparse
+import os
 from pathlib import Path
-import math
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+from cne_io import open_file, strip_compression
+
+parser = argparse.ArgumentParser()
+parser.add_argument("file1")
+parser.add_argument("file2")
+parser.add_argument("--local", action="store_true", help="compare shard pairs with local worker processes")
+parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes (--local)")
+parser.add_argument("--output", help="overlap file of --local (default: common_overlap_specific1_specific2.overlaps)")
+args = parser.parse_args()
 
-file1 = sys.argv[1]
-file2 = sys.argv[2]
+# #### Modules of the stage, imported once the arguments are parsed (see benchmark_imports.py)
+import numpy as np
+from overlap_join import overlap_cf_files
+from cne_store import write_overlap_table
+from cf_reader import cf_species, cf_column_names
+from stage_metrics import stage_metrics, startup_check
+startup_check()
+
+file1 = args.file1
+file2 = args.file2
 
 print("Creating directories for split CNEFinder files and overlap files")
 
 Path("./split_cf_files").mkdir(parents=True, exist_ok=True)
-Path("./overlap_files").mkdir(parents=True, exist_ok=True)
+if not args.local:
+    Path("./overlap_files").mkdir(parents=True, exist_ok=True)
 
 
 # #### Number of lines per file (recommended=10000)
 lines_per_file = 10000
 print("Number of lines per file: ", lines_per_file)
 
-# #### Split cnefinder input files
-def split_cf_file(cf_file):
-    smallfile = None
-    filenames = []
-    with open(cf_file) as big_file:
-        counter = 0
-        for lineno, line in enumerate(big_file):
-            if lineno % lines_per_file == 0:
-                counter+=1
-                if smallfile:
-                    smallfile.close()
-                small_filename = "split_cf_files/" + cf_file.split("/")[-1] + '_{}'.format(counter)
-                filenames.append(small_filename)
-                smallfile = open(small_filename, "w")
-            smallfile.write(line)
-        if smallfile:
-            smallfile.close()
-    return filenames
-
-file_names_1 = split_cf_file(file1)
-file_names_2 = split_cf_file(file2)
-combs = [(x,y) for x in file_names_1 for y in file_names_2]
-
-comp1 = file1.split("/")[-1].split(".out")[0].split("_vs_")
-comp2 = file2.split("/")[-1].split(".out")[0].split("_vs_")
+# #### Identify common and specific species names
+comp1 = list(cf_species(file1))
+comp2 = list(cf_species(file2))
 species_list = comp1 + comp2
 specific_species = []
 for sp, count in Counter(species_list).items():
@@ -49,13 +56,106 @@ for sp, count in Counter(species_list).items():
         common_species = sp
     elif count == 1:
         specific_species.append(sp)
+
+
+# #### Columns of the common species in CNEFinder files
+# chrom, start and end columns of the reference (first species) or query (second species)
+def common_columns(comp, header):
+    names = cf_column_names(header.rstrip("\n").split("\t"))
+    ref_query = "ref" if comp[0] == common_species else "query"
+    return names.index(ref_query + '_chrom'), names.index(ref_query + '_start'), names.index(ref_query + '_end')
+
+
+# #### Split cnefinder input files
+# Rows are sorted by chromosome and start coordinate of the common species,
+# each shard holds at most lines_per_file rows of a single chromosome and starts with the header line.
+# Returns list of shards: [shard_file_name, chrom, min_start, max_end, number_of_rows]
+def split_cf_file(cf_file, comp):
+    with open_file(cf_file) as big_file:
+        header = big_file.readline()
+        chrom_col, start_col, end_col = common_columns(comp, header)
+        rows = []
+        for line in big_file:
+            if not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            rows.append((fields[chrom_col], int(fields[start_col]), int(fields[end_col]), line))
+    rows.sort(key=lambda row: (row[0], row[1]))
+    shards = []
+    shard_rows = []
+    counter = 0
+    for row_index, row in enumerate(rows):
+        shard_rows.append(row)
+        last_row = row_index == len(rows) - 1
+        if last_row or len(shard_rows) == lines_per_file or rows[row_index + 1][0] != row[0]:
+            counter += 1
+            small_filename = "split_cf_files/" + strip_compression(cf_file.split("/")[-1]) + '_{}'.format(counter)
+            with open(small_filename, "w") as smallfile:
+                smallfile.write(header)
+                smallfile.writelines(shard_row[3] for shard_row in shard_rows)
+            shards.append([small_filename, row[0], min(shard_row[1] for shard_row in shard_rows),
+                           max(shard_row[2] for shard_row in shard_rows), len(shard_rows)])
+            shard_rows = []
+    # Record coordinate range of each shard
+    with open("split_cf_files/" + strip_compression(cf_file.split("/")[-1]) + ".shards.tsv", "w") as shard_file:
+        shard_file.write("shard\tchrom\tmin_start\tmax_end\tn_rows\n")
+        for shard in shards:
+            shard_file.write("\t".join(str(value) for value in shard) + "\n")
+    return shards
+
+
+# #### Function that tests if the coordinate ranges of two shards can contain overlapping CNEs
+# Chromosomes are not compared: overlaps are found on coordinates only, as in calculate_overlaps_split.py
+# (CNEFinder coordinates are positions on the concatenated padded scaffolds)
+def shards_overlap(shard1, shard2):
+    return shard1[2] <= shard2[3] and shard2[2] <= shard1[3]
+
+
+with stage_metrics("split", input_file=file1) as metrics:
+    shards_1 = split_cf_file(file1, comp1)
+    metrics['rows'] = sum(shard[4] for shard in shards_1)
+    metrics['bytes'] = os.path.getsize(file1)
+with stage_metrics("split", input_file=file2) as metrics:
+    shards_2 = split_cf_file(file2, comp2)
+    metrics['rows'] = sum(shard[4] for shard in shards_2)
+    metrics['bytes'] = os.path.getsize(file2)
+combs = [(x[0], y[0]) for x in shards_1 for y in shards_2 if shards_overlap(x, y)]
+print("Number of jobs: ", len(combs), " out of ", len(shards_1) * len(shards_2), " shard pairs")
+
 swarm_file = common_species + "_overlap_" + specific_species[0] + "_" + specific_species[1] + ".swarm"
-print("Writing swarm file:", swarm_file)
 
-with open(swarm_file, 'a') as output_file:
-    for comparison in combs:
-        output_file.write('python calculate_overlaps_split.py ' +  comparison[0] + " " + comparison[1] + " overlap_files/ ;\n")
+if not args.local:
+    print("Writing swarm file:", swarm_file)
+    with open(swarm_file, 'a') as output_file:
+        for comparison in combs:
+            output_file.write('python calculate_overlaps_split.py ' +  comparison[0] + " " + comparison[1] + " overlap_files/ ;\n")
+
+    print("Done. Make sure calculate_overlaps_split.py is in the current directory.")
+    print("Run swarm with 2G")
+
 
-print("Done. Make sure calculate_overlaps_split.py is in the current directory.")
-print("Run swarm with 2G")
+# #### Run shard pairs with local worker processes
+# Each worker runs one shard pair at a time, the next pair is sent to the first worker that is free.
+# Results are merged in shard pair order and renumbered, as merge_overlaps.py does.
+if args.local:
+    print("Comparing shard pairs with", args.workers, "worker processes")
+    results = {}
+    with stage_metrics("overlaps", input_file=file1 + "," + file2) as metrics:
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = {executor.submit(overlap_cf_files, x, y): job for job, (x, y) in enumerate(combs)}
+            for counter, future in enumerate(as_completed(futures)):
+                results[futures[future]] = future.result()
+                metrics['rows'] += len(results[futures[future]][1])
+                if counter % 100 == 0:
+                    print(counter, "shard pairs processed")
+    overlap_species = [common_species, specific_species[0], specific_species[1]]
+    starts = [results[job][1] for job in range(len(combs))]
+    ends = [results[job][2] for job in range(len(combs))]
+    starts = np.concatenate(starts) if starts else np.empty((0, 3), dtype=np.int64)
+    ends = np.concatenate(ends) if ends else np.empty((0, 3), dtype=np.int64)
+    output_file_name = args.output or (common_species + "_overlap_" + specific_species[0] + "_" + specific_species[1]
+                                       + ".overlaps")
+    print("Writing overlap file:", output_file_name, "number of overlaps:", len(starts))
+    write_overlap_table(output_file_name, overlap_species, np.arange(1, len(starts) + 1), starts, ends)
+    print("Done.")
 
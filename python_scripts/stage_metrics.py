@@ -0,0 +1,137 @@
+# # stage_metrics.py
+
+# ## Goal
+#
+# Resource metrics of each stage of the pipeline, shared by all scripts.
+# For each stage (and input file), one JSON line is appended to the metrics file:
+# {"script": ..., "stage": ..., "input": ..., "host": ..., "pid": ..., "status": ..., "start": ..., "wall_time": ...,
+#  "cpu_time": ..., "peak_rss": ..., "rows": ..., "bytes": ..., "rows_per_s": ..., "bytes_per_s": ...}
+# Times in seconds, peak_rss (peak resident memory of the process so far) and bytes in bytes.
+# cpu_time includes worker processes that ended during the stage.
+# status is "ok", or the name of the exception when the stage failed (e.g. "MemoryError", "KeyboardInterrupt"):
+# the metrics of failed stages are written too.
+#
+# Metrics are opt-in: they are written to the file given by the environment variable CNE_METRICS
+# (e.g. CNE_METRICS=pipeline_metrics.jsonl), nothing is written when CNE_METRICS is not set.
+# Swarm jobs can write to one file per job, e.g. CNE_METRICS=metrics_$SLURM_JOB_ID.jsonl.
+#
+# Profiling (opt-in): with CNE_PROFILE=directory, functions decorated with @profiled are run under cProfile
+# and their statistics are written to directory/script.function.pid.prof when the script ends
+# (view with: python -m pstats file.prof). Without CNE_PROFILE, @profiled returns the function unchanged.
+# Statistics are written at exit of the main process only: calls made in worker processes of a fork pool
+# (e.g. --workers) are lost, because pool workers end without running atexit functions.
+#
+# ## Usage
+#
+# with stage_metrics("overlaps", input_file=file1) as metrics:
+#     ...
+#     metrics['rows'] += len(rows)
+#     metrics['bytes'] += os.path.getsize(file1)
+#
+# @profiled
+# def overlap_join(...):
+#
+# Start-up check: with CNE_STARTUP_CHECK set, scripts stop once the modules of the stage are imported,
+# before their first useful work (see benchmark_imports.py):
+# import numpy as np
+# from stage_metrics import stage_metrics, startup_check
+# startup_check()
+#
+# ***
+
+import atexit
+import cProfile
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+from os.path import basename, join
+
+metrics_file = os.environ.get("CNE_METRICS", "")
+profile_dir = os.environ.get("CNE_PROFILE", "")
+script_name = basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python"
+
+
+def cpu_time():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def write_metrics(record):
+    if not metrics_file:
+        return
+    # One write per line: lines of jobs running in parallel are not mixed
+    with open(metrics_file, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+
+
+# #### Context manager that records the metrics of a stage
+# Yields a dictionary where rows and bytes processed are counted
+@contextmanager
+def stage_metrics(stage, input_file=None):
+    counts = {'rows': 0, 'bytes': 0}
+    start = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = cpu_time()
+    status = 'ok'
+    try:
+        yield counts
+    except BaseException as error:
+        # Failed stages are recorded too, with the name of the exception (e.g. MemoryError)
+        status = type(error).__name__
+        raise
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        write_metrics({'script': script_name, 'stage': stage, 'input': input_file, 'host': socket.gethostname(),
+                       'pid': os.getpid(), 'status': status, 'start': start, 'wall_time': wall_time,
+                       'cpu_time': cpu_time() - cpu_start, 'peak_rss': peak_rss(),
+                       'rows': counts['rows'], 'bytes': counts['bytes'],
+                       'rows_per_s': counts['rows'] / wall_time if wall_time > 0 else None,
+                       'bytes_per_s': counts['bytes'] / wall_time if wall_time > 0 else None})
+
+
+# #### Function that stops the script when CNE_STARTUP_CHECK is set, called once the modules of the stage are imported
+def startup_check():
+    if os.environ.get("CNE_STARTUP_CHECK"):
+        sys.exit()
+
+
+# #### Decorator that profiles a function when CNE_PROFILE is set
+# Statistics of all calls of the function in this process are written when the script ends.
+# Calls made while another profiled function runs are counted in the statistics of the outer function
+# (only one profiler can be active)
+active_profiles = []
+
+
+def profiled(function):
+    if not profile_dir:
+        return function
+    profile = cProfile.Profile()
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if active_profiles:
+            return function(*args, **kwargs)
+        active_profiles.append(profile)
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            active_profiles.pop()
+
+    def dump_stats():
+        if profile.getstats():
+            os.makedirs(profile_dir, exist_ok=True)
+            profile.dump_stats(join(profile_dir, ".".join([script_name, function.__name__, str(os.getpid()), "prof"])))
+
+    atexit.register(dump_stats)
+    return wrapper